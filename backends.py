@@ -0,0 +1,224 @@
+import os
+import re
+import uuid
+import shutil
+import logging
+import threading
+import contextlib
+from abc import ABC, abstractmethod
+
+from .dag import COMMENTS, split_statements
+from .metrics import spark_job_metrics
+from .watchdog import Watchdog, BudgetExceeded
+
+
+INSERT = re.compile(r"\s*INSERT\s+(OVERWRITE|INTO)\s+(?:TABLE\s+)?([\w.`]+)\s*(?:PARTITION\s*\(([^)]*)\))?\s*(.*)", re.I | re.S)
+SET = re.compile(r"\s*SET\b", re.I)
+
+
+class ExecutionBackend(ABC):
+    """
+    Base class of the engines an HQLQuery executes on. HQLQuery.run renders the query, keeps the metrics record and
+        calls the backend to execute it. Backends have to define execute and cancel.
+
+    Methods
+    -------
+    execute(hql_query, formatted_qs, run_settings, record):
+        Executes a formatted query (script) of hql_query, a temp query into its temp table
+
+    cancel(hql_query, job_group):
+        Stops an execution running in another thread
+
+    job_metrics(hql_query, record):
+        Extra fields for the metrics record of a finished execution
+    """
+    name = None
+
+    @abstractmethod
+    def execute(self, hql_query, formatted_qs, run_settings, record):
+        pass
+
+    @abstractmethod
+    def cancel(self, hql_query, job_group):
+        pass
+
+    def job_metrics(self, hql_query, record):
+        return {}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class SparkBackend(ExecutionBackend):
+    """
+    Default backend, the HQLQuery's SparkSession. Every execution runs under its own job group, watched by a Watchdog
+        when the query has a time_budget.
+    """
+    name = "spark"
+
+    def execute(self, hql_query, formatted_qs, run_settings, record):
+        # Job groups are per thread, so concurrent runs each get their own
+        spark_context = hql_query.spark.sparkContext
+        spark_context.setJobGroup(record["job_group"], f"HQLQuery {hql_query.table_name}")
+        try:
+            with Watchdog(spark_context, record["job_group"], hql_query.time_budget, hql_query.table_name) if hql_query.time_budget else contextlib.nullcontext() as watchdog:
+                try:
+                    hql_query._execute(formatted_qs, run_settings, record)
+                except Exception as error:
+                    if watchdog is not None and watchdog.exceeded:
+                        raise BudgetExceeded(hql_query.table_name, record["job_group"], hql_query.time_budget, watchdog.elapsed) from error
+                    raise
+
+            # Past the budget even when nothing was running to cancel, ex. Spark was still planning
+            if watchdog is not None and watchdog.exceeded:
+                raise BudgetExceeded(hql_query.table_name, record["job_group"], hql_query.time_budget, watchdog.elapsed)
+        finally:
+            spark_context.setLocalProperty("spark.jobGroup.id", None)
+            spark_context.setLocalProperty("spark.job.description", None)
+
+    def cancel(self, hql_query, job_group):
+        hql_query.spark.sparkContext.cancelJobGroup(job_group)
+
+    def job_metrics(self, hql_query, record):
+        return spark_job_metrics(hql_query.spark.sparkContext, record["job_group"])
+
+
+class LocalBackend(ExecutionBackend):
+    """
+    In process DuckDB engine over local Parquet files, for small data runs, CI and fast development loops. No JVM,
+        no cluster. duckdb is an optional dependency, imported on first use (pip install duckdb).
+
+    Tables live in data_dir as <schema>/<table>/[<partition column>=<value>/]part-<id>.parquet and are read through
+        views over those files, so "{env}.usage_daily" is data_dir/<env>/usage_daily. Statements are executed as DuckDB
+        SQL with a few HiveQL forms translated:
+            INSERT OVERWRITE/INTO TABLE t [PARTITION (column='value', ...)] SELECT ...: writes a Parquet file for the
+                table, replacing the partition (or the whole table) on overwrite. Static partitions only
+            SET: skipped, they are Spark configurations
+            `quoted` identifiers: "quoted"
+        Temp queries are written to {tmp_env}.<table_name> the same way, "memory" temp queries to a DuckDB table.
+        Everything else (statistics, write_options, time budgets, explain, incremental fingerprints) is Spark only.
+
+    Attributes
+    ----------
+    data_dir: str
+        Directory of the Parquet tables
+
+    tables: dictionary
+        Optional extra {table name: Parquet file, glob or directory} read as tables, ex. fixtures checked into a repo
+
+    database: str
+        DuckDB database, in memory by default
+    """
+    name = "local"
+
+    def __init__(self, data_dir, tables=None, database=":memory:"):
+        self.data_dir = data_dir
+        self.tables = tables or {}
+        self.database = database
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"LocalBackend({self.data_dir!r})"
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                try:
+                    import duckdb
+                except ImportError as error:
+                    raise ImportError("LocalBackend needs duckdb, pip install duckdb") from error
+
+                self._connection = duckdb.connect(self.database)
+                for table, path in self.tables.items():
+                    self._register(table, path)
+                if os.path.isdir(self.data_dir):
+                    for schema in sorted(os.listdir(self.data_dir)):
+                        if os.path.isdir(os.path.join(self.data_dir, schema)):
+                            for table in sorted(os.listdir(os.path.join(self.data_dir, schema))):
+                                self._register(f"{schema}.{table}", os.path.join(self.data_dir, schema, table))
+
+            return self._connection
+
+    def _register(self, table, path):
+        if os.path.isdir(path):
+            if not any(name.endswith(".parquet") for _, _, names in os.walk(path) for name in names):
+                return
+            path = os.path.join(path, "**", "*.parquet")
+
+        schema, name = table.split(".") if "." in table else ("main", table)
+        self._connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+        self._drop(schema, name)
+        self._connection.execute(f'CREATE OR REPLACE VIEW "{schema}"."{name}" AS SELECT * FROM '
+                                 f"read_parquet('{path}', hive_partitioning = true, union_by_name = true)")
+
+    def _drop(self, schema, name):
+        """
+        Drops schema.name, whether it's a view or a table. DuckDB won't replace one kind with the other
+        """
+        for kind, catalog in [("VIEW", "duckdb_views()"), ("TABLE", "duckdb_tables()")]:
+            if self._connection.execute(f"SELECT 1 FROM {catalog} WHERE schema_name = ? AND {kind.lower()}_name = ?", [schema, name]).fetchone():
+                self._connection.execute(f'DROP {kind} "{schema}"."{name}"')
+
+    def execute(self, hql_query, formatted_qs, run_settings, record):
+        # One connection, executions take turns
+        with self._lock:
+            *setup, last = split_statements(formatted_qs) or [formatted_qs]
+            for statement in setup:
+                self._statement(statement)
+
+            if not hql_query.is_temp:
+                logging.info(f"HQLQuery: Executing {hql_query.table_name} locally ...")
+                self._statement(last)
+            elif hql_query.temp_storage == "memory":
+                logging.info(f"HQLQuery: Executing TEMP query {hql_query.table_name} locally into a DuckDB table")
+                self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{run_settings["tmp_env"]}"')
+                # A view of the same name, ex. registered from an earlier Parquet temp table, would block the table
+                self._drop(run_settings["tmp_env"], hql_query.table_name)
+                self.connection.execute(f'CREATE OR REPLACE TABLE "{run_settings["tmp_env"]}"."{hql_query.table_name}" AS {self._translate(last)}')
+            else:
+                logging.info(f"HQLQuery: Executing TEMP query {hql_query.table_name} locally")
+                self._write(f"{run_settings['tmp_env']}.{hql_query.table_name}", last)
+
+    def cancel(self, hql_query, job_group):
+        if self._connection is not None:
+            self._connection.interrupt()
+
+    def _statement(self, statement):
+        insert = INSERT.match(COMMENTS.sub(" ", statement))
+        if insert:
+            mode, table, partition, select = insert.groups()
+            self._write(table.replace("`", ""), select, partition, overwrite=mode.upper() == "OVERWRITE")
+        elif SET.match(COMMENTS.sub(" ", statement)):
+            logging.debug(f"LocalBackend: skipping Spark configuration {statement.strip()}")
+        else:
+            self.connection.execute(self._translate(statement))
+
+    @staticmethod
+    def _translate(statement):
+        return statement.replace("`", '"')
+
+    def _write(self, table, select, partition=None, overwrite=True):
+        """
+        Writes the result of select as a Parquet file of table, under its static partition directory
+        """
+        columns = []
+        for column in (partition or "").split(","):
+            if column.strip():
+                name, _, value = column.partition("=")
+                if not value.strip():
+                    raise ValueError(f"LocalBackend doesn't support dynamic partitions, {name.strip()} of {table} has no value")
+                columns.append(f"{name.strip()}={value.strip().strip(chr(39) + chr(34))}")
+
+        schema, name = table.split(".") if "." in table else ("main", table)
+        directory = os.path.join(self.data_dir, schema, name)
+        target = os.path.join(directory, *columns)
+        with self._lock:
+            connection = self.connection
+            if overwrite and os.path.exists(target):
+                shutil.rmtree(target)
+            os.makedirs(target, exist_ok=True)
+            path = os.path.join(target, f"part-{uuid.uuid4().hex[:12]}.parquet")
+            connection.execute(f"COPY ({self._translate(select)}) TO '{path}' (FORMAT PARQUET)")
+            self._register(table, directory)
@@ -0,0 +1,323 @@
+"""
+Benchmarks of the driver side overhead of the package: startup, iterator window generation, HQL template construction and
+    rendering, and end to end HQLRunner.run bookkeeping. Spark itself is either a stub session that does no work
+    (--spark stub, the default, runs anywhere) or a local mode SparkSession (--spark local). With duckdb installed the
+    same templates are also run end to end on the local backend, and on local mode Spark over the same Parquet files
+    with --spark local, to compare the backends. --spark local also runs a two shard run_sharded backfill, each shard a
+    local mode Spark application, and fails if any of its windows does.
+
+    python -m etl_pytools.benchmarks --output bench.json --repeat 5
+
+Results are written as JSON so runs can be compared, one entry per benchmark with the timings of every repeat.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import statistics
+
+from .iterators import *
+from .file_io import HQLQuery, HQLTemplate, load_template, clear_template_cache
+from .runners import HQLRunner
+from .backends import SparkBackend, LocalBackend
+from .shards import run_sharded
+
+
+ITERATORS = {
+    "CalendarMonthIterator": (CalendarMonthIterator, {}),
+    "BillCycleIterator": (BillCycleIterator, {}),
+    "FiscalMonthIterator": (FiscalMonthIterator, {}),
+    "DailyIterator": (DailyIterator, {}),
+    "MultiDayIterator": (MultiDayIterator, {"days": 7}),
+    "FiscalCalendarMonthIterator": (FiscalCalendarMonthIterator, {}),
+}
+START_DATE = "2020-05-23"
+# (table_name, is_temp, query) run on every backend by bench_backends
+BACKEND_TEMPLATES = [
+    ("usage_agg", True, "select account_id, sum(bytes) as bytes from {env}.usage_daily "
+                        "where usage_date between '{start_date}' and '{end_date}' group by account_id"),
+    ("usage_summary", False, "insert overwrite table {env}.usage_summary partition (usage_day = '{start_date}') "
+                             "select account_id, bytes from {tmp_env}.usage_agg"),
+]
+
+
+class StubSparkSession():
+    """
+    Stand in for a SparkSession that accepts every call the package makes and does no work, so benchmarks measure
+        only the package's own overhead
+    """
+    class _Writer():
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self
+
+    class _DataFrame():
+        write = property(lambda self: StubSparkSession._Writer())
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: 0
+
+    class _StatusTracker():
+        def getJobIdsForGroup(self, job_group):
+            return []
+
+    class _SparkContext():
+        uiWebUrl = None
+        applicationId = "stub"
+
+        def statusTracker(self):
+            return StubSparkSession._StatusTracker()
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: None
+
+    class _Conf(dict):
+        def set(self, key, value):
+            self[key] = value
+
+        def unset(self, key):
+            self.pop(key, None)
+
+    def __init__(self):
+        self.sparkContext = StubSparkSession._SparkContext()
+        self.conf = StubSparkSession._Conf()
+        self.catalog = StubSparkSession._Writer()
+        self.statements = 0
+
+    def sql(self, query):
+        self.statements += 1
+        return StubSparkSession._DataFrame()
+
+
+# Query of bench_sharded, every window creates its own table so the shards' writes never share a directory
+SHARD_TEMPLATE = "create table bench_shards.`usage_{year_month}` using parquet as select id as account_id, id * 10 as bytes from range(10000)"
+
+
+def local_spark_session(warehouse_dir=None):
+    from pyspark.sql import SparkSession
+    builder = SparkSession.builder.master("local[2]").appName("etl_pytools-benchmarks").config("spark.ui.enabled", "false")
+    if warehouse_dir is not None:
+        builder = builder.config("spark.sql.warehouse.dir", warehouse_dir)
+    return builder.getOrCreate()
+
+
+def sharded_runner(warehouse_dir):
+    """
+    Runner factory of bench_sharded, called in every shard's worker process. Each worker is its own local mode Spark
+        application writing to the same warehouse directory
+    """
+    spark = local_spark_session(warehouse_dir)
+    spark.sql("CREATE DATABASE IF NOT EXISTS bench_shards")
+    return HQLRunner([HQLQuery(SHARD_TEMPLATE, table_name="usage", spark=spark)])
+
+
+def measure(name, func, repeat, operations, **params):
+    """
+    Times func repeat times. Returns the benchmark entry with the seconds of every repeat and the per operation cost
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    result = {"name": name, "params": params, "operations": operations, "timings": timings, "min": min(timings),
+              "median": statistics.median(timings), "mean": statistics.mean(timings),
+              "per_operation_us": statistics.median(timings) / operations * 1e6}
+    logging.info(f"Benchmark {name} {params}: {result['per_operation_us']:.2f} us per operation")
+    return result
+
+
+def bench_iterators(repeat, iterations=3650):
+    results = []
+    for name, (iterator_class, kwargs) in ITERATORS.items():
+        def drain():
+            iterator = iterator_class(START_DATE, iterations, logging=False, **kwargs)
+            while next(iterator, None) is not None:
+                continue
+
+        def plan():
+            iterator_class(START_DATE, iterations, logging=False, **kwargs).plan().table.date_dicts()
+
+        fiscal_month.cache_clear()
+        results.append(measure(f"iterator_next/{name}", drain, repeat, iterations, iterations=iterations))
+        results.append(measure(f"iterator_plan/{name}", plan, repeat, iterations, iterations=iterations))
+
+    return results
+
+
+def large_hql(lines):
+    selects = ",\n".join(f"    sum(case when usage_date between '{{start_date}}' and '{{end_date}}' then col_{i} end) as col_{i}" for i in range(lines))
+    return (f"insert overwrite table {{env}}.usage_summary partition (year_month = '{{year_month}}')\n"
+            f"select account_id,\n{selects}\nfrom {{env}}.usage_daily\n"
+            f"where usage_date between '{{start_date_expanded}}' and '{{end_date_expanded}}'\ngroup by account_id")
+
+
+def bench_templates(repeat, spark, lines=5000, renders=200):
+    text = large_hql(lines)
+    run_settings = {"env": "prod", **CalendarMonthIterator(START_DATE, 1, logging=False).plan()[0]}
+    template = HQLTemplate(text)
+
+    with tempfile.TemporaryDirectory() as hql_dir:
+        path = os.path.join(hql_dir, "usage_summary.hql")
+        with open(path, "w") as hql:
+            hql.write(text)
+
+        def cold_load():
+            clear_template_cache()
+            load_template(path)
+
+        def render():
+            for _ in range(renders):
+                template.render(run_settings)
+
+        def str_format():
+            for _ in range(renders):
+                text.format(**run_settings)
+
+        return [
+            measure("template_load/cold", cold_load, repeat, 1, lines=lines),
+            measure("template_load/cached", lambda: load_template(path), repeat, 1, lines=lines),
+            measure("hqlquery_construct", lambda: HQLQuery(text, table_name="usage_summary", spark=spark), repeat, 1, lines=lines),
+            measure("template_render", render, repeat, renders, lines=lines),
+            measure("str_format_baseline", str_format, repeat, renders, lines=lines),
+        ]
+
+
+def bench_runner(repeat, spark, windows=120, queries=20):
+    hql_queries = [HQLQuery(f"insert overwrite table {{env}}.table_{i} select * from {{env}}.table_{i - 1} "
+                            f"where usage_date between '{{start_date}}' and '{{end_date}}'", table_name=f"table_{i}", spark=spark)
+                   for i in range(queries)]
+    runner = HQLRunner(hql_queries)
+    logger = logging.getLogger()
+
+    def run():
+        # Keep the runner's per query logging out of the measurement
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            runner.run({"env": "prod"}, DailyIterator(START_DATE, windows, logging=False))
+        finally:
+            logger.setLevel(level)
+
+    return [measure("runner_run", run, repeat, windows * queries, windows=windows, queries=queries)]
+
+
+def bench_backends(repeat, spark=None, windows=10, rows=200000):
+    """
+    End to end runs of BACKEND_TEMPLATES on the local DuckDB backend over generated Parquet data, and on Spark over the
+        same files when spark is a real session. Skipped without duckdb.
+    """
+    try:
+        import duckdb
+    except ImportError:
+        logging.info("Benchmark backends: skipped, duckdb isn't installed")
+        return []
+
+    run_settings = {"env": "bench", "tmp_env": "bench_tmp"}
+    logger = logging.getLogger()
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        source = os.path.join(data_dir, "bench", "usage_daily")
+        os.makedirs(source)
+        duckdb.connect().execute(f"COPY (SELECT i % 1000 AS account_id, i AS bytes, DATE '{START_DATE}' - CAST(i % {windows} AS INTEGER) AS usage_date "
+                                 f"FROM range({rows}) t(i)) TO '{os.path.join(source, 'part-0.parquet')}' (FORMAT PARQUET)")
+
+        backends = {"local": LocalBackend(data_dir)}
+        if spark is not None and not isinstance(spark, StubSparkSession):
+            spark.sql("CREATE DATABASE IF NOT EXISTS bench")
+            spark.sql("CREATE DATABASE IF NOT EXISTS bench_tmp")
+            spark.sql(f"CREATE TABLE IF NOT EXISTS bench.usage_daily USING parquet LOCATION '{source}'")
+            spark.sql(f"CREATE TABLE IF NOT EXISTS bench.usage_summary (account_id BIGINT, bytes BIGINT, usage_day STRING) USING parquet "
+                      f"PARTITIONED BY (usage_day) LOCATION '{os.path.join(data_dir, 'spark', 'usage_summary')}'")
+            backends["spark"] = SparkBackend()
+
+        for name, backend in backends.items():
+            hql_queries = [HQLQuery(query, is_temp=is_temp, table_name=table_name, spark=spark) for table_name, is_temp, query in BACKEND_TEMPLATES]
+            runner = HQLRunner(hql_queries, backend=backend)
+
+            def run():
+                level = logger.level
+                logger.setLevel(logging.WARNING)
+                try:
+                    runner.run(run_settings, DailyIterator(START_DATE, windows, logging=False))
+                finally:
+                    logger.setLevel(level)
+
+            results.append(measure(f"backend_run/{name}", run, repeat, windows, windows=windows, rows=rows, queries=len(hql_queries)))
+
+    return results
+
+
+def bench_sharded(shards=2, windows=4):
+    """
+    Backfill split into shards local mode Spark applications by run_sharded. Runs once, worker processes each start
+        their own JVM. Raises with the report's summary when a window didn't succeed.
+    """
+    def run():
+        with tempfile.TemporaryDirectory() as work_dir:
+            report = run_sharded(sharded_runner, {}, CalendarMonthIterator(START_DATE, windows, logging=False), shards,
+                                 os.path.join(work_dir, "locks"), factory_args=(os.path.join(work_dir, "warehouse"),))
+            assert len(report) == windows and not report.failed(), f"Sharded backfill failed:\n{report.summary()}"
+
+    return [measure("sharded_run", run, 1, windows, shards=shards, windows=windows)]
+
+
+def bench_startup(repeat):
+    """
+    Fresh interpreter importing the package and building runners of HQLQueries, the startup cost of planning, tests or 
+        CLI validation. Spark must not be imported on that path, the result records whether it was.
+    """
+    package = __package__ or __name__.rsplit(".", 1)[0]
+    script = (f"import sys, time; start = time.perf_counter(); from {package}.runners import HQLRunner, HQLQuery; "
+              f"HQLRunner([HQLQuery('select {{start_date}}', table_name=f'table_{{i}}') for i in range(50)]); "
+              f"print(time.perf_counter() - start, 'pyspark' in sys.modules)")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(path for path in sys.path if path)}
+
+    timings, pyspark_imported = [], None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True).stdout.split()
+        timings.append(float(output[0]))
+        pyspark_imported = output[1] == "True"
+
+    result = {"name": "startup/import_and_build", "params": {"queries": 50, "pyspark_imported": pyspark_imported}, "operations": 1,
+              "timings": timings, "min": min(timings), "median": statistics.median(timings), "mean": statistics.mean(timings),
+              "per_operation_us": statistics.median(timings) * 1e6}
+    logging.info(f"Benchmark startup: {result['median']:.3f} s, pyspark imported: {pyspark_imported}")
+    return [result]
+
+
+def run_benchmarks(output, spark="stub", repeat=5):
+    """
+    Runs every benchmark and writes the results to output as JSON. Returns the results dictionary.
+    """
+    session = StubSparkSession() if spark == "stub" else local_spark_session()
+    results = (bench_startup(repeat) + bench_iterators(repeat) + bench_templates(repeat, session) + bench_runner(repeat, session)
+               + bench_backends(repeat, session) + (bench_sharded() if spark == "local" else []))
+
+    report = {"created_at": datetime.datetime.now().isoformat(), "python": sys.version.split()[0], "platform": platform.platform(),
+              "spark": spark, "repeat": repeat, "results": results}
+    with open(output, "w") as bench:
+        json.dump(report, bench, indent=2)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Driver side benchmarks for HQLRunner, iterators and HQL templates")
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file the results are written to")
+    parser.add_argument("--spark", choices=["stub", "local"], default="stub", help="stub session (offline) or local mode PySpark")
+    parser.add_argument("--repeat", type=int, default=5, help="timed repeats of every benchmark")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    run_benchmarks(args.output, args.spark, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import re
+
+
+COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", re.S)
+TABLE_NAME = r"([\w{}`]+(?:\.[\w{}`]+)?)"
+
+# FROM and JOIN keywords, "IS DISTINCT FROM" is captured to be skipped
+SOURCE_KEYWORDS = re.compile(r"[()]|\b(?:(DISTINCT)\s+)?(FROM|JOIN)\b", re.I)
+SUBQUERY = re.compile(r"\(\s*(?:SELECT|WITH|FROM|VALUES)\b", re.I)
+SOURCE = re.compile(r"\s*" + TABLE_NAME + r"\s*(\()?")
+SOURCE_SEPARATOR = re.compile(r"\s*,")
+TABLESAMPLE = re.compile(r"\s*TABLESAMPLE\s*\(", re.I)
+WRITES = re.compile(r"\bINSERT\s+(?:INTO|OVERWRITE)\s+(?:TABLE\s+)?" + TABLE_NAME
+                    + r"|\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:GLOBAL\s+)?(?:TEMP(?:ORARY)?\s+)?(?:EXTERNAL\s+)?(?:TABLE|VIEW)\s+(?:IF\s+NOT\s+EXISTS\s+)?" + TABLE_NAME, re.I)
+CTES = re.compile(r"(?:\bWITH|,)\s*(\w+)\s+AS\s*\(", re.I)
+TEMP_VIEWS = re.compile(r"\bCREATE\s+(?:OR\s+REPLACE\s+)?(?:GLOBAL\s+)?TEMP(?:ORARY)?\s+VIEW\s+(?:IF\s+NOT\s+EXISTS\s+)?" + TABLE_NAME, re.I)
+# Join conditions and filters, up to the next clause
+PREDICATES = re.compile(r"\b(?:ON|WHERE|HAVING)\b(.*?)(?=\b(?:JOIN|LEFT|RIGHT|FULL|INNER|CROSS|SEMI|ANTI|WHERE|GROUP|ORDER|HAVING|LIMIT|UNION|"
+                        r"WINDOW|DISTRIBUTE|CLUSTER|SORT|SELECT|INSERT)\b|;|$)", re.I | re.S)
+USING = re.compile(r"\bUSING\s*\(([^)]*)\)", re.I)
+COLUMN = re.compile(r"(?:(\w+)\.)?([A-Za-z_]\w*)\b(?!\s*\()")
+# Words of a predicate that COLUMN matches but aren't columns
+SQL_KEYWORDS = {"and", "or", "not", "is", "null", "in", "between", "like", "rlike", "ilike", "regexp", "case", "when", "then", "else", 
+                "end", "true", "false", "exists", "any", "all", "some", "distinct", "from", "interval", "date", "timestamp", "escape", 
+                "select", "on", "where", "having", "as"}
+CLAUSE_WORDS = (r"(?!(?:ON|WHERE|JOIN|LEFT|RIGHT|FULL|INNER|CROSS|SEMI|ANTI|NATURAL|GROUP|ORDER|HAVING|LIMIT|UNION|INTERSECT|EXCEPT|MINUS|"
+                r"LATERAL|USING|WINDOW|DISTRIBUTE|CLUSTER|SORT|SELECT|INSERT|TABLESAMPLE|PIVOT|UNPIVOT)\b)")
+ALIAS = re.compile(r"\s*(?:AS\s+)?" + CLAUSE_WORDS + r"(\w+)(?:\s*(\())?", re.I)
+SET_STATEMENT = re.compile(r"\s*(?:SET|RESET)\b", re.I)
+# Quoted text and comments are skipped whole, so only the semicolons left over end a statement
+STATEMENT_TOKENS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|--[^\n]*|/\*.*?\*/|;", re.S)
+PLACEHOLDER = re.compile(r"(\{[^{}]*\})")
+
+
+def normalize_table(name):
+    """
+    Case insensitive form of a table name. Placeholders keep their case, so a name taken from an unformatted query 
+        (ex. "{ENV}.Voice") still renders with the run_settings, and is normalized again once rendered
+    """
+    return "".join(part if PLACEHOLDER.fullmatch(part) else part.lower() for part in PLACEHOLDER.split(name.replace("`", "")))
+
+
+def strip_sql(query_string):
+    """
+    Removes comments and string literals so table references inside them aren't picked up
+    """
+    return STRINGS.sub("''", COMMENTS.sub(" ", query_string))
+
+
+def split_statements(query_string):
+    """
+    Splits a script into its statements on the semicolons outside of string literals, quoted identifiers and comments. 
+        Empty and comment only statements are dropped. A script without a semicolon comes back unchanged as its only statement.
+    """
+    if ";" not in query_string:
+        return [query_string] if query_string.strip() else []
+
+    statements, start = [], 0
+    for token in STATEMENT_TOKENS.finditer(query_string):
+        if token.group() == ";":
+            statements.append(query_string[start:token.start()])
+            start = token.end()
+    statements.append(query_string[start:])
+
+    return [statement.strip() for statement in statements if strip_sql(statement).strip()]
+
+
+def extract_temp_views(query_string):
+    """
+    Names of the temp views a script creates. They live in the SparkSession, so two executions creating the same 
+        view at the same time replace each other's
+    """
+    return {normalize_table(name) for name in TEMP_VIEWS.findall(strip_sql(query_string))}
+
+
+def closing_parenthesis(query_string, position):
+    """
+    Position right after the parenthesis closing the one opened at position, the end of the string when it's never closed
+    """
+    depth = 0
+    for match in re.finditer(r"[()]", query_string[position:]):
+        depth += 1 if match.group() == "(" else -1
+        if depth == 0:
+            return position + match.end()
+
+    return len(query_string)
+
+
+def extract_sources(query_string):
+    """
+    Tables the FROM and JOIN clauses of a query read, comma separated FROM lists included, as (table, alias) pairs with 
+        alias None when the table has none. FROM inside a function call (ex. EXTRACT(year FROM usage_date)) isn't a 
+        clause, subqueries and table functions (ex. range(10)) aren't tables, their own FROMs are read separately.
+
+    Returns
+    -------
+    (sources, complete): list of pairs, and whether every FROM and JOIN clause could be parsed
+    """
+    query_string = strip_sql(query_string)
+    sources, complete, parentheses = [], True, []
+    for keyword in SOURCE_KEYWORDS.finditer(query_string):
+        if keyword.group() == "(":
+            parentheses.append(keyword.start())
+            continue
+        if keyword.group() == ")":
+            if parentheses:
+                parentheses.pop()
+            continue
+        if keyword.group(1) or (parentheses and not SUBQUERY.match(query_string, parentheses[-1])):
+            continue
+
+        position = keyword.end()
+        while True:
+            table = None
+            source = SOURCE.match(query_string, position)
+            if source is None:
+                # A subquery, or something only a real parser would read, ex. a parenthesized join
+                opening = query_string.find("(", position)
+                if opening < 0 or query_string[position:opening].strip() or not SUBQUERY.match(query_string, opening):
+                    complete = False
+                    break
+                position = closing_parenthesis(query_string, opening)
+            elif source.group(2):
+                position = closing_parenthesis(query_string, source.end() - 1)
+            else:
+                table, position = source.group(1), source.end()
+
+            sample = TABLESAMPLE.match(query_string, position)
+            if sample:
+                position = closing_parenthesis(query_string, sample.end() - 1)
+            alias = ALIAS.match(query_string, position)
+            if alias:
+                # Column aliases, ex. AS t(a, b)
+                position = closing_parenthesis(query_string, alias.end() - 1) if alias.group(2) else alias.end()
+            if table is not None:
+                sources.append((table, alias.group(1) if alias else None))
+
+            separator = SOURCE_SEPARATOR.match(query_string, position)
+            if keyword.group(2).upper() == "JOIN" or separator is None:
+                break
+            position = separator.end()
+
+    return sources, complete
+
+
+def extract_predicate_columns(query_string, table):
+    """
+    Columns of table a query joins or filters on: the ones in its ON/USING, WHERE and HAVING clauses that are qualified 
+        with the table's name or alias, and the unqualified ones (which may belong to another table, check them against 
+        the table's columns). table is matched like extract_tables names it, ex. "{tmp_env}.voice_temp".
+    """
+    table = normalize_table(table)
+    aliases = {table.split(".")[-1].lower()}
+    for source, alias in extract_sources(query_string)[0]:
+        if alias and normalize_table(source) == table:
+            aliases.add(alias.lower())
+
+    query_string = strip_sql(query_string).replace("`", "")
+
+    columns = set()
+    for predicate in PREDICATES.findall(query_string) + USING.findall(query_string):
+        for qualifier, column in COLUMN.findall(predicate):
+            if qualifier.lower() in aliases or not (qualifier or column.lower() in SQL_KEYWORDS):
+                columns.add(column.lower())
+
+    return columns
+
+
+def extract_tables(query_string):
+    """
+    Pulls the table names a query reads and writes. Names are taken from the unformatted query string, so
+        placeholders stay in the name (ex. "{tmp_env}.voice_temp"), which is what lets two queries in the same runner be matched.
+        Temp views a multi statement script creates count as writes, so its own later statements reading them aren't reads.
+
+    Returns
+    -------
+    (reads, writes): tuple of sets
+    """
+    query_string = strip_sql(query_string)
+    ctes = {normalize_table(name) for name in CTES.findall(query_string)}
+    writes = {normalize_table(a or b) for a, b in WRITES.findall(query_string)}
+    reads = {normalize_table(name) for name, _ in extract_sources(query_string)[0]} - ctes - writes
+
+    return reads, writes
+
+
+def is_barrier(query_string):
+    """
+    Whether a script has a statement touching tables in a way extract_tables can't see, ex. TRUNCATE, DROP TABLE, 
+        ALTER TABLE ... DROP PARTITION or MSCK REPAIR: a statement without any read or write other than SET/RESET, or 
+        with a FROM or JOIN clause extract_sources can't parse
+    """
+    for statement in split_statements(query_string):
+        if SET_STATEMENT.match(strip_sql(statement)):
+            continue
+        if extract_tables(statement) == (set(), set()) or not extract_sources(statement)[1]:
+            return True
+
+    return False
+
+
+class QueryGraph():
+    """
+    Dependency graph between the HQLQueries of a runner. A query depends on an earlier query in the list when it reads
+        a table the earlier one writes, writes a table the earlier one writes, or overwrites a table the earlier one reads.
+        Queries with a statement the graph can't see the tables of (see is_barrier) are barriers: they wait for every 
+        earlier query and every later query waits for them.
+        Running the queries in any order that respects those edges gives the same result as running the list in order.
+
+    Attributes
+    ----------
+    hql_queries: list
+        HQLQueries in the order given to the runner
+
+    reads: list of sets
+        Table names read by each HQLQuery
+
+    writes: list of sets
+        Table names written by each HQLQuery. Temp queries also write "{tmp_env}.<table_name>"
+
+    barriers: list of booleans
+        Whether each HQLQuery is a barrier
+
+    dependencies: list of sets
+        Indexes of the queries each query has to wait for
+
+    Methods
+    -------
+    ready(done, started):
+        Indexes of the queries that can start given the finished and already started ones
+
+    critical_path(weights=None):
+        Longest chain of dependent queries
+
+    describe(weights=None):
+        Printable description of the DAG and its critical path
+    """
+    def __init__(self, hql_queries):
+        self.hql_queries = hql_queries
+        self.reads, self.writes = [], []
+        self.barriers = [is_barrier(hql_query.query_string) for hql_query in hql_queries]
+        for hql_query in hql_queries:
+            reads, writes = extract_tables(hql_query.query_string)
+            if hql_query.is_temp:
+                writes.add(normalize_table(f"{{tmp_env}}.{hql_query.table_name}"))
+            self.reads.append(reads)
+            self.writes.append(writes)
+
+        self.dependencies = []
+        for i in range(len(hql_queries)):
+            self.dependencies.append({j for j in range(i) if self.barriers[i] or self.barriers[j] or self.reads[i] & self.writes[j]
+                                                            or self.writes[i] & (self.writes[j] | self.reads[j])})
+
+    def __len__(self):
+        return len(self.hql_queries)
+
+    def ready(self, done, started):
+        return [i for i in range(len(self)) if i not in started and self.dependencies[i] <= done]
+
+    def critical_path(self, weights=None):
+        """
+        Parameters
+        ----------
+        weights: dictionary
+            Optional {table_name: expected seconds}. Queries missing from it count as 1
+
+        Returns
+        -------
+        (path, cost): list of query indexes and the summed weight along it
+        """
+        weights = weights or {}
+        cost, previous = [], []
+        for i, hql_query in enumerate(self.hql_queries):
+            before = max(self.dependencies[i], key=lambda j: cost[j], default=None)
+            cost.append(weights.get(hql_query.table_name, 1) + (cost[before] if before is not None else 0))
+            previous.append(before)
+
+        if not cost:
+            return [], 0
+
+        i = max(range(len(cost)), key=lambda i: cost[i])
+        path = []
+        while i is not None:
+            path.append(i)
+            i = previous[i]
+
+        return path[::-1], cost[path[0]]
+
+    def describe(self, weights=None):
+        lines = [f"HQL Runner plan: {len(self)} queries"]
+        for i, hql_query in enumerate(self.hql_queries):
+            temp = (" (TEMP)" if hql_query.is_temp else "") + (" (BARRIER)" if self.barriers[i] else "")
+            waits_on = ", ".join(self.hql_queries[j].table_name for j in sorted(self.dependencies[i])) or "-"
+            lines.append(f"\t[{i}] {hql_query.table_name}{temp} | waits on: {waits_on}")
+            lines.append(f"\t\treads: {', '.join(sorted(self.reads[i])) or '-'} | writes: {', '.join(sorted(self.writes[i])) or '-'}")
+
+        path, cost = self.critical_path(weights)
+        lines.append(f"Critical path ({cost}): " + " -> ".join(self.hql_queries[i].table_name for i in path))
+
+        return "\n".join(lines)
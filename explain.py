@@ -0,0 +1,215 @@
+import re
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+
+from .ledger import query_hash
+from .dag import split_statements, strip_sql
+
+
+# Analyzed plans by formatted query hash, {hash: plan text} in least recently used order
+PLAN_CACHE_SIZE = 1024
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+UNITS = {"B": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30, "TiB": 1 << 40, "PiB": 1 << 50, "EiB": 1 << 60}
+SIZE = re.compile(r"sizeInBytes=([\d.]+)\s*(B|KiB|MiB|GiB|TiB|PiB|EiB)?")
+RELATION = re.compile(r"(?:HiveTableRelation \[?([\w`.]+)|Relation\s*(?:\[[^\]]*\]\s*)?([\w`.]*)).*?Statistics\(sizeInBytes=([\d.]+)\s*(\w+)?")
+FILE_SCAN = re.compile(r"FileScan \w+ ([\w`.]+)\[([^\]]*)\]")
+HIVE_SCAN = re.compile(r"Scan hive ([\w`.]+) \[([^\]]*)\]")
+PARTITION_FILTERS = re.compile(r"PartitionFilters: \[(.*?)\](?:, \w+:|$)")
+PRUNED_PARTITIONS = re.compile(r"Pruned Partitions: \[(.*?)\]\]")
+PATHS = re.compile(r"\((\d+) paths\)")
+JOIN_STRATEGY = re.compile(r"\b(BroadcastHashJoin|SortMergeJoin|ShuffledHashJoin|BroadcastNestedLoopJoin|CartesianProduct)\b")
+# Statements of a script that don't touch any data, safe to run ahead of explaining its last statement
+LAZY_STATEMENT = re.compile(r"\s*(?:CREATE\s+(?:OR\s+REPLACE\s+)?(?:GLOBAL\s+)?TEMP(?:ORARY)?\s+VIEW|SET|USE)\b", re.I)
+SET_CONF = re.compile(r"\s*SET\s+([^=\s]+)\s*=", re.I)
+
+
+def to_bytes(number, unit):
+    return int(float(number) * UNITS.get(unit or "B", 1))
+
+
+def explain_cost(spark, formatted_qs):
+    """
+    Plan text of EXPLAIN COST for a formatted query. Spark only analyzes and optimizes the query, nothing runs.
+        Plans are cached by query hash, so explaining the same window and query again is free. Only the last statement 
+        of a script is explained, after its temp view, SET and USE statements. Statements that would write are skipped, 
+        and the configurations and current database the script changes are restored afterwards.
+    """
+    key = query_hash(formatted_qs)
+    with _plan_cache_lock:
+        if key in _plan_cache:
+            _plan_cache.move_to_end(key)
+            return _plan_cache[key], True
+
+    with prepared_last_statement(spark, formatted_qs) as last:
+        plan = spark.sql(f"EXPLAIN COST {last}").collect()[0][0]
+
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+    return plan, False
+
+
+@contextlib.contextmanager
+def prepared_last_statement(spark, formatted_qs):
+    """
+    Runs the temp view, SET and USE statements of a script and yields its last statement to explain. Statements that 
+        would write are skipped. On exit the configurations the SET statements changed and the current database are put 
+        back, so a dry run doesn't change the session for what runs after it. The temp views stay.
+    """
+    *setup, last = split_statements(formatted_qs) or [formatted_qs]
+    lazy = [statement for statement in setup if LAZY_STATEMENT.match(strip_sql(statement))]
+    for statement in setup:
+        if statement not in lazy:
+            logging.warning(f"Dry run: skipping a statement that would execute: {statement[:80]}")
+
+    keys = {key.group(1) for key in map(SET_CONF.match, map(strip_sql, lazy)) if key}
+    previous_conf = {key: spark.conf.get(key, None) for key in keys}
+    database = spark.catalog.currentDatabase() if lazy else None
+    try:
+        for statement in lazy:
+            spark.sql(statement)
+        yield last
+    finally:
+        for key, value in previous_conf.items():
+            if value is None:
+                spark.conf.unset(key)
+            else:
+                spark.conf.set(key, value)
+        if database is not None and spark.catalog.currentDatabase() != database:
+            spark.catalog.setCurrentDatabase(database)
+
+
+def join_strategies(spark, formatted_qs):
+    """
+    Join operators of a query's physical plan in plan order, ex. ["BroadcastHashJoin", "SortMergeJoin"]. Not cached, 
+        the point is to see the plan change when statistics do. Side effect free: only the last statement of a script is 
+        explained, none of its setup statements run, so one reading the script's own temp views can't be explained
+    """
+    last = (split_statements(formatted_qs) or [formatted_qs])[-1]
+    plan = spark.sql(f"EXPLAIN {last}").collect()[0][0]
+    return JOIN_STRATEGY.findall(plan)
+
+
+def clear_plan_cache():
+    with _plan_cache_lock:
+        _plan_cache.clear()
+
+
+def pruning_fired(partition_filters, date_columns=None):
+    """
+    True when a scan's partition filters actually restrict partitions: isnotnull() alone doesn't, and with date_columns
+        given at least one filter has to be on one of them
+    """
+    filters = [expression for expression in re.split(r",\s*(?![^()]*\))", partition_filters or "") if expression and not expression.startswith("isnotnull")]
+    if date_columns:
+        filters = [expression for expression in filters if any(re.search(rf"\b{re.escape(column)}#", expression) for column in date_columns)]
+
+    return len(filters) > 0
+
+
+def analyze_plan(plan, date_columns=None):
+    """
+    Pulls the estimates out of EXPLAIN COST text
+
+    Returns
+    -------
+    dictionary: estimated_output_bytes, estimated_input_bytes, the scans of the physical plan (table, partition_filters, 
+        partitions, pruned) and pruning_fired. partitions is the number of paths/partitions Spark lists for the scan when 
+        the plan shows it. pruning_fired is True when every scan reading one of the date_columns (every scan without 
+        date_columns) pruned partitions, None when there are no such scans
+    """
+    sizes = SIZE.findall(plan)
+    relations = RELATION.findall(plan)
+
+    scans = []
+    for line in plan.splitlines():
+        file_scan, hive_scan = FILE_SCAN.search(line), HIVE_SCAN.search(line)
+        if file_scan:
+            partition_filters = PARTITION_FILTERS.search(line)
+            paths = PATHS.search(line)
+            scan = {"table": file_scan.group(1).replace("`", ""), "columns": file_scan.group(2),
+                    "partition_filters": partition_filters.group(1) if partition_filters else "",
+                    "partitions": int(paths.group(1)) if paths else None}
+            scan["pruned"] = pruning_fired(scan["partition_filters"], date_columns)
+        elif hive_scan:
+            pruned_partitions = PRUNED_PARTITIONS.search(line)
+            scan = {"table": hive_scan.group(1).replace("`", ""), "columns": hive_scan.group(2),
+                    "partition_filters": pruned_partitions.group(1) if pruned_partitions else "",
+                    "partitions": len(re.findall(r"\(", pruned_partitions.group(1))) if pruned_partitions else None}
+            scan["pruned"] = pruned_partitions is not None
+        else:
+            continue
+        scans.append(scan)
+
+    relevant = [scan for scan in scans if not date_columns or any(re.search(rf"\b{re.escape(column)}#", scan["columns"]) for column in date_columns)]
+    return {"estimated_output_bytes": to_bytes(*sizes[0]) if sizes else None,
+            "estimated_input_bytes": sum(to_bytes(number, unit) for _, _, number, unit in relations) if relations else None,
+            "scans": scans,
+            "pruning_fired": all(scan["pruned"] for scan in relevant) if relevant else None}
+
+
+class ExplainReport():
+    """
+    What a dry run found for every (window, HQLQuery) pair
+
+    Attributes
+    ----------
+    entries: list
+        One dictionary per pair with label, table_name, start_date, end_date, query_hash, cached (plan came from the plan cache),
+            error (when Spark couldn't analyze the query, ex. a temp table that doesn't exist yet) and the analyze_plan fields
+
+    Methods
+    -------
+    summary():
+        One line per entry, estimated sizes and whether partition pruning fired
+    """
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        self.entries.append(entry)
+
+    def total_input_bytes(self):
+        return sum(entry.get("estimated_input_bytes") or 0 for entry in self.entries)
+
+    def unpruned(self):
+        return [entry for entry in self.entries if entry.get("pruning_fired") is False]
+
+    def summary(self):
+        lines = [f"Dry run: {len(self)} queries, ~{self.total_input_bytes()} input bytes, {len(self.unpruned())} without partition pruning"]
+        for entry in self.entries:
+            if entry.get("error"):
+                lines.append(f"\t{entry['table_name']} ({entry['start_date']}, {entry['end_date']}) | ERROR {entry['error']}")
+                continue
+            partitions = sum(scan["partitions"] or 0 for scan in entry["scans"])
+            lines.append(f"\t{entry['table_name']} ({entry['start_date']}, {entry['end_date']}) | input ~{entry['estimated_input_bytes']} bytes"
+                         f" | output ~{entry['estimated_output_bytes']} bytes | partitions {partitions} | pruning {entry['pruning_fired']}")
+
+        return "\n".join(lines)
+
+
+def explain_window(report, hql_queries, window_settings, label=None, date_columns=None):
+    """
+    Explains every HQLQuery for one window's settings and adds the results to report
+    """
+    for hql_query in hql_queries:
+        formatted_qs = hql_query.render(window_settings)
+        entry = {"label": label, "table_name": hql_query.table_name, "start_date": window_settings.get("start_date"),
+                 "end_date": window_settings.get("end_date"), "query_hash": query_hash(formatted_qs), "error": None}
+        try:
+            plan, entry["cached"] = explain_cost(hql_query.spark, formatted_qs)
+            entry.update(analyze_plan(plan, date_columns))
+        except Exception as error:
+            logging.warning(f"Dry run: couldn't analyze {hql_query.table_name} for {label}: {error!r}")
+            entry.update({"cached": False, "error": repr(error), "scans": [], "estimated_output_bytes": None,
+                          "estimated_input_bytes": None, "pruning_fired": None})
+        report.add(entry)
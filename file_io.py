@@ -1,11 +1,146 @@
 import os 
 import sys
 import logging
-from pyspark.sql import SparkSession
+import string
+import threading
+import re
+import math
+import uuid
+import contextlib
+from collections import OrderedDict
 from .utils import *
+from .session import SessionProvider
+from .metrics import new_record
+from .dag import split_statements
+from .explain import join_strategies
+from .backends import SparkBackend
 import time
 
 
+# Process wide cache of parsed HQL files, {resolved path: (mtime, HQLTemplate)} in least recently used order
+TEMPLATE_CACHE_SIZE = 256
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+_formatter = string.Formatter()
+
+# How temp tables are written unless HQLQuery.write_options says otherwise, see HQLQuery
+DEFAULT_WRITE_OPTIONS = {"format": "orc", "compression": None, "partition_by": None, "dynamic_overwrite": False,
+                         "bucket_by": None, "sort_by": None, "target_file_bytes": None}
+
+
+class HQLTemplate():
+    """
+    A query string parsed once into its literal text and placeholders, so rendering it for every window doesn't 
+        reparse the whole string. Renders exactly like str.format(**run_settings). 
+
+    Attributes
+    ----------
+    text: str
+        The unformatted query string
+
+    placeholders: set
+        Names of the run_settings the query string needs (ex. {"start_date", "tmp_env"})
+
+    Methods 
+    -------
+    missing(run_settings):
+        Placeholders that run_settings doesn't supply
+
+    render(run_settings):
+        Formats the query string with run_settings. Raises a KeyError listing every missing placeholder before anything is formatted
+    """
+    def __init__(self, text):
+        self.text = text
+        self.segments = []
+        for literal, field_name, format_spec, conversion in _formatter.parse(text):
+            self.segments.append((literal, field_name, format_spec, conversion))
+
+        # Format specs can hold placeholders of their own (ex. "{value:{width}}")
+        field_names = [field_name for _, field_name, _, _ in self.segments if field_name]
+        field_names += [name for _, _, format_spec, _ in self.segments if format_spec for _, name, _, _ in _formatter.parse(format_spec) if name]
+        self.placeholders = {field_name.split(".")[0].split("[")[0] for field_name in field_names}
+
+        # HQL repeats the same few placeholders many times, so each distinct one is formatted once per render and 
+        #   every segment just points at its value. The last value is "" for the trailing literal without a field.
+        self.literals = [literal for literal, _, _, _ in self.segments]
+        self.fields = list(dict.fromkeys((field_name, format_spec, conversion) for _, field_name, format_spec, conversion in self.segments if field_name is not None))
+        positions = {field: i for i, field in enumerate(self.fields)}
+        self.field_positions = [positions.get((field_name, format_spec, conversion), len(self.fields))
+                                for _, field_name, format_spec, conversion in self.segments]
+
+    def missing(self, run_settings):
+        return self.placeholders - set(run_settings or {})
+
+    def render(self, run_settings):
+        run_settings = run_settings or {}
+        missing = self.missing(run_settings)
+        if missing:
+            raise KeyError(f"HQLTemplate: run_settings is missing {', '.join(sorted(missing))}")
+
+        values = []
+        for field_name, format_spec, conversion in self.fields:
+            value, _ = _formatter.get_field(field_name, (), run_settings)
+            value = _formatter.convert_field(value, conversion)
+            if format_spec and "{" in format_spec:
+                format_spec = _formatter.vformat(format_spec, (), run_settings)
+            values.append(format(value, format_spec))
+        values.append("")
+
+        return "".join([literal + values[i] for literal, i in zip(self.literals, self.field_positions)])
+
+
+def load_template(file_path):
+    """
+    Returns the HQLTemplate of a file, reading and parsing it only when it isn't cached or has changed since. 
+    """
+    file_path = os.path.realpath(file_path)
+    mtime = os.stat(file_path).st_mtime_ns
+
+    with _template_cache_lock:
+        cached = _template_cache.get(file_path)
+        if cached is not None and cached[0] == mtime:
+            _template_cache.move_to_end(file_path)
+            return cached[1]
+
+    with open(file_path) as hql:
+        template = HQLTemplate(hql.read())
+
+    with _template_cache_lock:
+        _template_cache[file_path] = (mtime, template)
+        _template_cache.move_to_end(file_path)
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+
+    return template
+
+
+def parse_bytes(value):
+    """
+    Bytes of a Spark size configuration, ex. "9223372036854775807b", "10m" or "1g"
+    """
+    number, unit = re.fullmatch(r"\s*(\d+)\s*([kmgtp]?)b?\s*", str(value), re.I).groups()
+    return int(number) * 1024 ** " kmgtp".index(unit.lower() or " ")
+
+
+def estimate_size(df):
+    """
+    Spark's estimate of a DataFrame's size in bytes from its optimized plan. None when the plan has no estimate, including 
+        when Spark fell back to spark.sql.defaultSizeInBytes (Long.MaxValue unless set), ex. Hive tables without statistics
+    """
+    try:
+        size = int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+        unknown = parse_bytes(df.sparkSession.conf.get("spark.sql.defaultSizeInBytes", str(2 ** 63 - 1)))
+    except Exception:
+        return None
+
+    return None if size >= unknown else size
+
+
+def clear_template_cache():
+    with _template_cache_lock:
+        _template_cache.clear()
+
+
 class HQLFile():
 
     def __init__(self, file_name):
@@ -23,7 +158,11 @@ class HQLFile():
             self.script_version = ''
 
     def read(self):
-        return open(self.emr_file_path).read()
+        with open(self.emr_file_path) as hql:
+            return hql.read()
+
+    def template(self):
+        return load_template(self.emr_file_path)
 
 
 class HQLQuery():
@@ -31,6 +170,10 @@ class HQLQuery():
     Class to manage the File IO and Spark running of HQL files housed on HDFS. The class constructor hides all the 
         messy string manipulation that gets us the formatted EMR file path. 
 
+    A file can hold a script of several statements separated by semicolons. The statements before the last one run 
+        first, in order. CREATE TEMP VIEW steps stay lazy, so Spark plans them together with the last statement, which 
+        is the only one materialized (the SELECT of a temp query, or the INSERT of the others).
+
     Attributes
     ----------
     file_name: str
@@ -41,46 +184,310 @@ class HQLQuery():
     is_temp: boolean
         Indicates the location of the saved table, either externally in S3 (False) or 
             on HDFS in cluster (True)
+
+    temp_storage: str
+        How temp tables are kept. "orc" (default) saves them to {tmp_env}.<table_name> on HDFS as write_options describe. 
+            "memory" persists the result as a temp view named <table_name> at storage_level instead, falling back to the 
+            table when Spark estimates the result above max_memory_bytes. Runners point the later queries reading 
+            {tmp_env}.<table_name> at the view.
+
+    write_options: dictionary
+        How temp tables are written, any of (defaults in DEFAULT_WRITE_OPTIONS)
+            format: "orc" (default), "parquet", ...
+            compression: codec ex. "zstd", "snappy". Spark's default for the format when None
+            partition_by: list of partition columns
+            dynamic_overwrite: only replace the partitions the window writes rather than the whole table. Needs 
+                partition_by, and the partition columns last in the select (the table is written with insertInto)
+            bucket_by: (number of buckets, list of columns), sort_by: list of columns sorting each bucket
+            target_file_bytes: output file size to aim for. The result is coalesced (or repartitioned by partition_by) 
+                to Spark's estimated size / target_file_bytes tasks, so a small window doesn't write thousands of files
+
+    storage_level: str
+        pyspark StorageLevel name used for "memory" temp tables. Defaults to "MEMORY_AND_DISK"
+
+    max_memory_bytes: int
+        Largest estimated result kept in memory. Defaults to 1GB
+
+    compute_statistics: boolean
+        Computes table statistics of a temp table right after it's written, so the queries reading it can plan with its 
+            real size (ex. broadcast it rather than sort merge join it). Column statistics are computed for 
+            statistics_columns, which runners set to the columns their later queries join or filter on. Runners also 
+            set statistics_probes, the (table_name, formatted query) of those queries, and log how their joins change.
+
+    time_budget: float
+        Optional seconds an execution may take. A watchdog thread samples the progress of its Spark stages, warns about 
+            straggler tasks (see watchdog.Watchdog), and cancels its job group once the budget runs out. run() then raises 
+            BudgetExceeded
+
+    metrics_sinks: MetricsSink or list
+        Sinks receiving one structured record per run (see metrics.MetricsSink for the fields). Every run executes 
+            under its own Spark job group, which is how its jobs, stages, rows/bytes written and shuffle are found.
+
+    profiler: callable
+        Optional hook called with the metrics record, returning a context manager wrapped around the Spark execution 
+            ex. profiler=lambda record: cProfile.Profile()
+
+    spark: SparkSession
+        Optional session to run in. By default the session comes from the session provider on the first run, so 
+            building HQLQueries (for planning, tests or validation) doesn't start Spark
+
+    session: str or SessionProvider
+        Optional name of a registered session configuration (see session.register_session_config) or provider to get 
+            the session from. Defaults to the shared default session
+
+    backend: ExecutionBackend
+        Engine the query executes on (see backends). Defaults to SparkBackend, backends.LocalBackend runs it in process 
+            with DuckDB over local Parquet files
     
     Methods 
     -------
     read():
         Reads the contents of the HQL file. No formatting just reads
 
-    run(run_settings):
-        Formats the HQL query using run_settings and executes the HQL Query in Spark
+    render(run_settings):
+        Formats the HQL query using run_settings. Files are parsed once per process and cached (see load_template)
+
+    run(run_settings, formatted_qs=None, job_group=None):
+        Formats the HQL query using run_settings and executes the HQL Query on its backend. Pass formatted_qs to run a query 
+            that was already rendered, and job_group (see new_job_group) to be able to cancel it from another thread
+
+    cancel(job_group):
+        Cancels a running execution, its Spark jobs through its job group
+
+    analyze(table, columns=None, probes=None):
+        Computes table and column statistics, logging their cost and the join changes of the probe queries
+
+    release_view():
+        Unpersists and drops the temp view of a "memory" temp table
     
     """
-    def __init__(self, query, is_temp=False, table_name=None):
+    def __init__(self, query, is_temp=False, table_name=None, temp_storage="orc", storage_level="MEMORY_AND_DISK", max_memory_bytes=1 << 30,
+                 metrics_sinks=None, profiler=None, spark=None, session=None, write_options=None, 
+                 compute_statistics=False, time_budget=None, backend=None):
         if table_name:
-            self.query_string = query
+            self.template = HQLTemplate(query)
             self.table_name = table_name
         
         else:
             ## If you want to read from a file your table name can only be saved as the name of the file. 
             hql_file = HQLFile(query)
-            self.query_string = hql_file.read()
+            self.template = hql_file.template()
             self.table_name = hql_file.file_name.split("/")[-1]
 
         self.is_temp = is_temp       
-        self.spark = SparkSession.builder.getOrCreate()
+        self.temp_storage = temp_storage
+        self.storage_level = storage_level
+        self.max_memory_bytes = max_memory_bytes
+        self.write_options = {**DEFAULT_WRITE_OPTIONS, **(write_options or {})}
+        self.compute_statistics = compute_statistics
+        self.time_budget = time_budget
+        self.statistics_columns = None
+        self.statistics_probes = []
+        # DataFrame behind the temp view while a "memory" temp table is cached
+        self.view = None
+        self.metrics_sinks = [metrics_sinks] if metrics_sinks is not None and type(metrics_sinks) is not list else (metrics_sinks or [])
+        self.profiler = profiler
+        # Time of the last render in each thread, so runs of queries the runner rendered report it too
+        self._render_seconds = threading.local()
+        self.session = session if isinstance(session, SessionProvider) else SessionProvider(session)
+        self._spark = spark
+        self.backend = backend or SparkBackend()
+
+    @property
+    def query_string(self):
+        return self.template.text
 
-    def run(self, run_settings):
+    @query_string.setter
+    def query_string(self, query_string):
+        self.template = HQLTemplate(query_string)
+
+    @property
+    def spark(self):
+        # Created on first use rather than in the constructor
+        if self._spark is None:
+            self._spark = self.session.get()
+        return self._spark
+
+    @spark.setter
+    def spark(self, spark):
+        self._spark = spark
+
+    def render(self, run_settings):
+        start = time.time()
+        formatted_qs = self.template.render(run_settings)
+        self._render_seconds.value = time.time() - start
+
+        return formatted_qs
+
+    def run(self, run_settings, formatted_qs=None, job_group=None):
+        record = new_record(self, run_settings)
         start = time.time()
-        formatted_qs = self.query_string.format(**run_settings)
+        formatted_qs = self.render(run_settings) if formatted_qs is None else formatted_qs
         logging.log(level=10, msg = formatted_qs)
+        record["render_seconds"] = getattr(self._render_seconds, "value", None)
+
+        record["job_group"] = job_group or self.new_job_group()
+
+        execution_start = time.time()
+        try:
+            with self.profiler(record) if self.profiler else contextlib.nullcontext():
+                self.backend.execute(self, formatted_qs, run_settings, record)
+            record["status"] = "succeeded"
+        except Exception as error:
+            record["status"], record["error"] = "failed", repr(error)
+            raise
+        finally:
+            record["execution_seconds"] = time.time() - execution_start
+            self._emit(record)
+
+        end = time.time()
+        _ , run_time_in_minutes = timer(start, end)
+        logging.info(f"HQLQuery: ***FINISHED*** {self.table_name} in {run_time_in_minutes} minutes")
+
+    def new_job_group(self):
+        return f"{self.table_name}-{uuid.uuid4().hex[:12]}"
+
+    def cancel(self, job_group):
+        """
+        Cancels an execution running in another thread, on Spark the jobs of its job group. Its run() raises once the 
+            backend stops it.
+        """
+        logging.warning(f"HQLQuery: Cancelling {self.table_name} (job group {job_group})")
+        self.backend.cancel(self, job_group)
+
+    def _execute(self, formatted_qs, run_settings, record=None):
+        *setup, formatted_qs = split_statements(formatted_qs) or [formatted_qs]
+        for i, statement in enumerate(setup):
+            logging.info(f"HQLQuery: {self.table_name} statement {i + 1} of {len(setup) + 1}")
+            self.spark.sql(statement)
 
         if self.is_temp:
-            logging.info(f"HQLQuery: Executing TEMP query {self.table_name}")
-            self.spark.sql(formatted_qs).write.format("orc").mode("overwrite").saveAsTable(f"{run_settings['tmp_env']}.{self.table_name}")
+            self.release_view()
+            df = self.spark.sql(formatted_qs)
+            size = estimate_size(df) if self.temp_storage == "memory" else None
+
+            if size is not None and size <= self.max_memory_bytes:
+                logging.info(f"HQLQuery: Executing TEMP query {self.table_name} into a {self.storage_level} temp view (~{size} bytes)")
+                from pyspark import StorageLevel
+                df.persist(getattr(StorageLevel, self.storage_level))
+                df.createOrReplaceTempView(self.table_name)
+                df.count() # Materialize once so every reader hits the cache
+                self.view = df
+
+            else:
+                if self.temp_storage == "memory":
+                    logging.info(f"HQLQuery: {self.table_name} estimated at {size} bytes, spilling to {self.write_options['format']}")
+                logging.info(f"HQLQuery: Executing TEMP query {self.table_name}")
+                self._write(df, f"{run_settings['tmp_env']}.{self.table_name}", size)
+                if self.compute_statistics:
+                    seconds = self.analyze(f"{run_settings['tmp_env']}.{self.table_name}", self.statistics_columns, self.statistics_probes)
+                    if record is not None:
+                        record["statistics_seconds"] = seconds
 
         else: 
             logging.info(f"HQLQuery: Executing {self.table_name} ...")
             self.spark.sql(formatted_qs)
-            
-        end = time.time()
-        _ , run_time_in_minutes = timer(start, end)
-        print(f"***FINISHED*** in {run_time_in_minutes} minutes")
-        print("---------------------------------------------------------------------------------")
-        print("\n")
+
+    def analyze(self, table, columns=None, probes=None):
+        """
+        Computes the table statistics of table, and the column statistics of the columns it has out of columns. probes are 
+            (name, formatted query) pairs whose join strategies are logged when the statistics change them. Returns the 
+            seconds the statistics took.
+        """
+        before = {name: self._joins(formatted_qs) for name, formatted_qs in probes or []}
+
+        start = time.time()
+        self.spark.sql(f"ANALYZE TABLE {table} COMPUTE STATISTICS")
+        table_columns = {column.lower() for column in self.spark.table(table).columns}
+        columns = sorted({column.lower() for column in columns or []} & table_columns)
+        if columns:
+            # The table is already written, column statistics it can't have (ex. unsupported types) don't fail the query
+            try:
+                self.spark.sql(f"ANALYZE TABLE {table} COMPUTE STATISTICS FOR COLUMNS {', '.join(columns)}")
+            except Exception as error:
+                logging.warning(f"HQLQuery: Couldn't compute the column statistics of {table}: {error!r}")
+                columns = []
+        seconds = time.time() - start
+        logging.info(f"HQLQuery: Statistics of {table} computed in {round(seconds, 2)} seconds, columns: {', '.join(columns) or '-'}")
+
+        for name, formatted_qs in probes or []:
+            after = self._joins(formatted_qs)
+            if before[name] is not None and after is not None and before[name] != after:
+                logging.info(f"HQLQuery: Joins of {name} changed with the statistics of {table}: {', '.join(before[name])} -> {', '.join(after)}")
+
+        return seconds
+
+    def _joins(self, formatted_qs):
+        try:
+            return join_strategies(self.spark, formatted_qs)
+        except Exception as error:
+            logging.debug(f"HQLQuery: couldn't explain the joins of a query reading {self.table_name}: {error!r}")
+            return None
+
+    def _write(self, df, table, size=None):
+        """
+        Writes a temp result to table as write_options describe
+        """
+        options = self.write_options
+        partition_by = list(options["partition_by"] or [])
+
+        if options["target_file_bytes"]:
+            size = size if size is not None else estimate_size(df)
+            if size is not None:
+                # Never more tasks than the result already has, or than a shuffle would give it
+                try:
+                    max_files = max(df.rdd.getNumPartitions(), int(self.spark.conf.get("spark.sql.shuffle.partitions", "200")))
+                except ValueError:
+                    max_files = df.rdd.getNumPartitions()
+                files = min(max(1, math.ceil(size / options["target_file_bytes"])), max_files)
+                if partition_by:
+                    df = df.repartition(files, *partition_by)
+                elif files < df.rdd.getNumPartitions():
+                    df = df.coalesce(files)
+                else:
+                    df = df.repartition(files)
+                logging.info(f"HQLQuery: Writing {self.table_name} as ~{files} files (~{size} bytes)")
+
+        writer = df.write.format(options["format"]).mode("overwrite")
+        if options["compression"]:
+            writer = writer.option("compression", options["compression"])
+
+        if options["dynamic_overwrite"] and partition_by and self.spark.catalog.tableExists(table):
+            # insertInto keeps the table and, in dynamic mode, only replaces the partitions present in df
+            writer.option("partitionOverwriteMode", "dynamic").insertInto(table, overwrite=True)
+            return
+
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        if options["bucket_by"]:
+            buckets, columns = options["bucket_by"]
+            writer = writer.bucketBy(buckets, *columns)
+            if options["sort_by"]:
+                writer = writer.sortBy(*options["sort_by"])
+        writer.saveAsTable(table)
+
+    def _emit(self, record):
+        if not self.metrics_sinks:
+            return
+
+        try:
+            record.update(self.backend.job_metrics(self, record))
+        except Exception as error:
+            logging.debug(f"HQLQuery: couldn't collect {self.backend.name} metrics for {self.table_name}: {error!r}")
+
+        # Metrics never fail a query, nor hide the error of a failed one
+        for sink in self.metrics_sinks:
+            try:
+                sink.emit(record)
+            except Exception as error:
+                logging.warning(f"HQLQuery: couldn't emit the metrics of {self.table_name} to {sink.__class__.__name__}: {error!r}")
+
+    def release_view(self):
+        if self.view is None:
+            return
+
+        logging.info(f"HQLQuery: Releasing TEMP view {self.table_name}")
+        self.view.unpersist()
+        self.spark.catalog.dropTempView(self.table_name)
+        self.view = None
 
@@ -0,0 +1,121 @@
+import os
+import json
+import logging
+import heapq
+import datetime
+import threading
+import statistics
+
+from .metrics import MetricsSink
+
+
+def window_days(window_settings):
+    """
+    Days a window spans, 1 when its dates are missing or aren't dates
+    """
+    start_date, end_date = window_settings.get("start_date"), window_settings.get("end_date")
+    if start_date is None or end_date is None:
+        return 1
+    try:
+        if isinstance(start_date, str) or isinstance(end_date, str):
+            start_date, end_date = datetime.date.fromisoformat(str(start_date)[:10]), datetime.date.fromisoformat(str(end_date)[:10])
+        return abs((end_date - start_date).days) + 1
+    except (TypeError, ValueError):
+        return 1
+
+
+def predict_schedule(predicted_seconds, workers):
+    """
+    Finish times (seconds from the start) of windows submitted in order to workers slots, each window taking its
+        predicted seconds and starting as soon as a slot frees up
+    """
+    slots = [0.0] * max(1, workers or 1)
+    finishes = []
+    for seconds in predicted_seconds:
+        finish = heapq.heappop(slots) + seconds
+        heapq.heappush(slots, finish)
+        finishes.append(finish)
+
+    return finishes
+
+
+class RunHistory(MetricsSink):
+    """
+    Local history of HQLQuery run times, kept as a JSONL file of the successful executions' metrics records. Runners
+        given a history feed it and use it to submit the expected longest windows first.
+
+    Predictions for a (table_name, iterator_type, start_date, end_date) window use, in order: the latest run of the same
+        window, the table's median seconds per window day for the iterator (then for any iterator) times the window's days,
+        and the median seconds per day of every table times the window's days. None without any history.
+
+    Methods
+    -------
+    emit(record):
+        Adds a succeeded metrics record to the history
+
+    predict(table_name, window_settings):
+        Expected seconds of one HQLQuery execution
+
+    predict_window(hql_queries, window_settings):
+        Expected seconds of a window, the sum over its queries. Windows nothing is known about count their days
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.latest, self._per_day = {}, {}
+        if os.path.exists(path):
+            with open(path) as history:
+                for line in history:
+                    if line.strip():
+                        # A bad line (ex. cut short by a crash) only loses that execution
+                        try:
+                            self._add(json.loads(line))
+                        except (ValueError, TypeError, KeyError) as error:
+                            logging.warning(f"RunHistory: skipping a bad line of {path}: {error!r}")
+
+    @staticmethod
+    def key(table_name, window_settings):
+        return (table_name, window_settings.get("iterator_type"), str(window_settings.get("start_date")), str(window_settings.get("end_date")))
+
+    def _add(self, entry):
+        window = {"iterator_type": entry["iterator_type"], "start_date": entry["start_date"], "end_date": entry["end_date"]}
+        per_day = entry["execution_seconds"] / window_days(window)
+        self.latest[self.key(entry["table_name"], window)] = entry["execution_seconds"]
+        for group in [(entry["table_name"], entry["iterator_type"]), (entry["table_name"], None), (None, None)]:
+            self._per_day.setdefault(group, []).append(per_day)
+
+    def emit(self, record):
+        if record.get("status") != "succeeded" or record.get("execution_seconds") is None or record.get("start_date") is None:
+            return
+
+        entry = {"table_name": record["table_name"], "iterator_type": record["iterator_type"], "start_date": str(record["start_date"]),
+                 "end_date": str(record["end_date"]) if record.get("end_date") is not None else None,
+                 "execution_seconds": record["execution_seconds"], "started_at": record.get("started_at")}
+        with self._lock:
+            # Added before it's written, so an entry the history can't use never reaches the file
+            try:
+                self._add(entry)
+            except (ValueError, TypeError) as error:
+                logging.warning(f"RunHistory: not recording {entry['table_name']}: {error!r}")
+                return
+            with open(self.path, "a") as history:
+                history.write(json.dumps(entry) + "\n")
+
+    def predict(self, table_name, window_settings):
+        with self._lock:
+            seconds = self.latest.get(self.key(table_name, window_settings))
+            if seconds is not None:
+                return seconds
+
+            for group in [(table_name, window_settings.get("iterator_type")), (table_name, None), (None, None)]:
+                if group in self._per_day:
+                    return statistics.median(self._per_day[group]) * window_days(window_settings)
+
+        return None
+
+    def predict_window(self, hql_queries, window_settings):
+        predictions = [self.predict(hql_query.table_name, window_settings) for hql_query in hql_queries]
+        if all(seconds is None for seconds in predictions):
+            return float(window_days(window_settings))
+
+        return sum(seconds or 0 for seconds in predictions)
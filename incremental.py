@@ -0,0 +1,141 @@
+import logging
+import calendar
+import datetime
+import threading
+
+from .ledger import CheckpointLedger
+
+
+def partition_range(value):
+    """
+    (first day, last day) a partition value covers, ex. "2020-05-01" -> one day, "2020-05" -> the month. None when it isn't a date
+    """
+    for date_format in ["%Y-%m-%d", "%Y%m%d", "%Y-%m"]:
+        try:
+            first_day = datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+        if date_format == "%Y-%m":
+            return first_day, first_day.replace(day=calendar.monthrange(first_day.year, first_day.month)[1])
+        return first_day, first_day
+
+    return None
+
+
+def table_version(spark, table, window_settings=None):
+    """
+    Version of a table's data as a string, None when it can't be determined (views, temp views, missing tables).
+        Delta tables use their latest commit version. Other tables use the size, file count and modification time of
+        their location on the Hadoop FileSystem, restricted to the date partitions overlapping the window's
+        (expanded) start and end dates when the table is partitioned by a date. Partitions outside the window can
+        change without invalidating it.
+    """
+    try:
+        rows = spark.sql(f"DESCRIBE TABLE EXTENDED {table}").collect()
+        info = {row[0].strip(): row[1] for row in rows if row[0]}
+        if (info.get("Provider") or "").lower() == "delta":
+            return f"delta:{spark.sql(f'DESCRIBE HISTORY {table} LIMIT 1').collect()[0]['version']}"
+
+        location = info.get("Location")
+        if not location:
+            return None
+
+        jvm = spark.sparkContext._jvm
+        path = jvm.org.apache.hadoop.fs.Path(location)
+        file_system = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+
+        window_settings = window_settings or {}
+        window_start = window_settings.get("start_date_expanded", window_settings.get("start_date"))
+        window_end = window_settings.get("end_date_expanded", window_settings.get("end_date"))
+
+        statuses = [status for status in file_system.listStatus(path) if status.isDirectory() and "=" in status.getPath().getName()]
+        if not statuses:
+            statuses = [file_system.getFileStatus(path)]
+
+        elif window_start is not None and window_end is not None:
+            in_window = []
+            for status in statuses:
+                dates = partition_range(status.getPath().getName().split("=", 1)[1])
+                if dates is None or (dates[0] <= window_end and dates[1] >= window_start):
+                    in_window.append(status)
+            statuses = in_window
+
+        versions = []
+        for status in statuses:
+            summary = file_system.getContentSummary(status.getPath())
+            versions.append(f"{status.getPath().getName()}:{summary.getLength()}:{summary.getFileCount()}:{status.getModificationTime()}")
+
+        return ",".join(sorted(versions))
+
+    except Exception as error:
+        logging.debug(f"Incremental: couldn't version {table}: {error!r}")
+        return None
+
+
+class FingerprintCache():
+    """
+    Skip cache for incremental re-runs. An execution's fingerprint is its formatted query (and the formatted queries of
+        the runner's queries feeding it) plus the version of every input table those queries don't write. An
+        execution is skipped when its fingerprint matches the one recorded for the output table's last successful
+        write of the same window. Fingerprints are kept in a CheckpointLedger file.
+
+    Attributes
+    ----------
+    ledger: CheckpointLedger
+        Where the fingerprints of the last successful writes are kept
+
+    hits, misses, unknown: int
+        Executions skipped, executions run because their fingerprint changed or was never recorded, and executions run
+            because an input couldn't be versioned
+
+    Methods
+    -------
+    fingerprint(spark, formatted_queries, input_tables, window_settings):
+        Fingerprint text of an execution, None when an input can't be versioned
+
+    unchanged(unit, fingerprint):
+        True (a hit) when the fingerprint matches the last successful write of the unit
+
+    record(unit, fingerprint):
+        Records a successful write
+
+    stats():
+        Hit/miss counts and hit rate
+    """
+    def __init__(self, path):
+        self.ledger = CheckpointLedger(path)
+        self.hits, self.misses, self.unknown = 0, 0, 0
+        self._lock = threading.Lock()
+
+    def fingerprint(self, spark, formatted_queries, input_tables, window_settings=None):
+        versions = []
+        for table in sorted(input_tables):
+            version = table_version(spark, table, window_settings)
+            if version is None:
+                return None
+            versions.append(f"-- {table}: {version}")
+
+        return "\n".join(list(formatted_queries) + versions)
+
+    def unchanged(self, unit, fingerprint):
+        with self._lock:
+            if fingerprint is None:
+                self.unknown += 1
+                return False
+
+        hit = self.ledger.is_done(unit, fingerprint)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return hit
+
+    def record(self, unit, fingerprint):
+        if fingerprint is not None:
+            self.ledger.record(unit, fingerprint)
+
+    def stats(self):
+        total = self.hits + self.misses + self.unknown
+        return {"hits": self.hits, "misses": self.misses, "unknown": self.unknown, "hit_rate": self.hits / total if total else None}
@@ -1,5 +1,8 @@
-
 import datetime
+import functools
+import itertools
+from array import array
+from abc import abstractmethod
 from collections.abc import Iterator
 from dateutil.relativedelta import relativedelta
 import logging
@@ -7,12 +10,239 @@ from MVNO_python_tools.mvno_etl_tools import find_fiscal
 
 TODAY = datetime.date.today()
 
+
+@functools.lru_cache(maxsize=None)
+def fiscal_month(year, month):
+    """
+    find_fiscal memoized per (year, month). Fiscal calendars don't change mid run, so every iterator shares one lookup per month
+    """
+    return find_fiscal(year, month)
+
+
+def make_date_dict(start_date, end_date, label_date, expand_days, iterator_abbrev):
+    """
+    Builds the dictionary of date variables used to format HQL queries for a single window. 
+        label_date is the date the month_name and year_month come from (the fiscal month for fiscal iterators, the start date otherwise)
+    """
+    date_dict = {}
+    #Format dates in ET
+    date_dict['start_date'] = start_date
+    date_dict['end_date']   = end_date
+
+    #Format dates extensions
+    date_dict['start_date_expanded'] = start_date - datetime.timedelta(days=expand_days[0])
+    date_dict['end_date_expanded']   = end_date + datetime.timedelta(days=expand_days[1])
+
+    #Values that help with
+    date_dict["month_name"] = label_date.strftime("%B")
+    date_dict["year_month"] = label_date.strftime("%Y-%m")
+
+    #bill cycle dates based on the start and end dates - must start the prior month (specific to mvno cube so far)
+    date_dict['bill_cycle_start_date'] = (start_date - relativedelta(months=1)).replace(day=1)
+    date_dict['bill_cycle_end_date']   = end_date.replace(day=1)
+
+    date_dict["iterator_type"] = iterator_abbrev
+
+    return date_dict
+
+
+class WindowTable():
+    """
+    Every window of an iterator computed up front and stored column wise. Dates are kept as ordinals (date.toordinal()) 
+        in compact array('l') columns, so a multi-year daily schedule costs a few bytes per window. The derived dates and 
+        labels of the date_dicts are columns too, computed once per table (the label strings once per month), so reading 
+        a window only builds its dictionary.
+
+    Attributes
+    ----------
+    start, end, label: array
+        Ordinals of each window's start date, end date and the date its month_name/year_month come from
+
+    start_expanded, end_expanded, bill_cycle_start, bill_cycle_end: array
+        Ordinals of each window's derived dates (see make_date_dict)
+
+    month_name, year_month: list
+        Labels of each window, shared between the windows of a month
+
+    next_anchor: date
+        Where the iterator would continue after the last window
+
+    expand_days: list
+        [days before start_date, days after end_date] for the expanded dates
+
+    iterator_abbrev: str
+        iterator_type of the windows
+
+    Methods 
+    -------
+    window(i):
+        (start_date, end_date, label_date) of the i-th window
+
+    date_dict(i):
+        date_dict of the i-th window, the same dictionary the iterator returns from next()
+
+    date_dicts():
+        date_dict of every window
+    """
+    def __init__(self, step, anchor, iterations, expand_days, iterator_abbrev):
+        self.start, self.end, self.label = array("l"), array("l"), array("l")
+        self.anchor = anchor
+        self.expand_days = expand_days
+        self.iterator_abbrev = iterator_abbrev
+
+        for _ in range(iterations):
+            start_date, end_date, label_date, anchor = step(anchor)
+            self.start.append(start_date.toordinal())
+            self.end.append(end_date.toordinal())
+            self.label.append(label_date.toordinal())
+
+        self.next_anchor = anchor
+        self.start_expanded = array("l", [start - expand_days[0] for start in self.start])
+        self.end_expanded = array("l", [end + expand_days[1] for end in self.end])
+
+        # First days of months by month arithmetic rather than relativedelta, and each month's labels formatted once
+        def first_day(ordinal, months_back=0):
+            date = datetime.date.fromordinal(ordinal)
+            months = date.year * 12 + date.month - 1 - months_back
+            return datetime.date(months // 12, months % 12 + 1, 1).toordinal()
+
+        labels = {}
+        self.month_name, self.year_month = [], []
+        for label in self.label:
+            label_date = datetime.date.fromordinal(label)
+            month = (label_date.year, label_date.month)
+            if month not in labels:
+                labels[month] = (label_date.strftime("%B"), label_date.strftime("%Y-%m"))
+            self.month_name.append(labels[month][0])
+            self.year_month.append(labels[month][1])
+
+        self.bill_cycle_start = array("l", [first_day(start, 1) for start in self.start])
+        self.bill_cycle_end = array("l", [first_day(end) for end in self.end])
+
+    def __len__(self):
+        return len(self.start)
+
+    def window(self, i):
+        return (datetime.date.fromordinal(self.start[i]), datetime.date.fromordinal(self.end[i]), 
+                datetime.date.fromordinal(self.label[i]))
+
+    def date_dict(self, i):
+        # Same keys, in the same order, as make_date_dict
+        fromordinal = datetime.date.fromordinal
+        return {"start_date": fromordinal(self.start[i]), "end_date": fromordinal(self.end[i]),
+                "start_date_expanded": fromordinal(self.start_expanded[i]), "end_date_expanded": fromordinal(self.end_expanded[i]),
+                "month_name": self.month_name[i], "year_month": self.year_month[i],
+                "bill_cycle_start_date": fromordinal(self.bill_cycle_start[i]), "bill_cycle_end_date": fromordinal(self.bill_cycle_end[i]),
+                "iterator_type": self.iterator_abbrev}
+
+    def date_dicts(self):
+        return [self.date_dict(i) for i in range(len(self))]
+
+
+class WindowPlan():
+    """
+    Immutable, random access view over the windows of a WindowTable. Slicing, reversing and chunking only produce new 
+        views (a range of row numbers over the same table), so a backfill can be split up, sharded or resumed from any 
+        window without replaying an iterator. Runners accept a WindowPlan, or any iterable of date_dicts (ex. chain_plans), 
+        anywhere they accept an iterator. 
+
+    Attributes
+    ----------
+    table: WindowTable
+        Windows the plan reads from
+
+    indexes: range
+        Rows of the table in the plan, in order
+
+    iterator_name: str
+        Class name of the iterator the windows came from, used in log messages
+
+    Methods 
+    -------
+    window(i):
+        (start_date, end_date, label_date) of the i-th window in the plan
+
+    reverse():
+        The plan in reverse order
+
+    chunks(size):
+        Consecutive plans of at most size windows
+
+    shards(n):
+        n interleaved plans (every n-th window) that together cover the plan
+    """
+    def __init__(self, table, indexes=None, iterator_name=None):
+        self.table = table
+        self.indexes = range(len(table)) if indexes is None else indexes
+        self.iterator_name = iterator_name
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __iter__(self):
+        return (self.table.date_dict(i) for i in self.indexes)
+
+    def __reversed__(self):
+        return iter(self.reverse())
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return WindowPlan(self.table, self.indexes[key], self.iterator_name)
+
+        return self.table.date_dict(self.indexes[key])
+
+    def __repr__(self):
+        if len(self) == 0:
+            return f"WindowPlan({self.iterator_name}, 0 windows)"
+        return f"WindowPlan({self.iterator_name}, {len(self)} windows, {self.window(0)[0]} .. {self.window(-1)[1]})"
+
+    def window(self, i):
+        return self.table.window(self.indexes[i])
+
+    def reverse(self):
+        return self[::-1]
+
+    def chunks(self, size):
+        return [self[i:i + size] for i in range(0, len(self), size)]
+
+    def shards(self, n):
+        return [self[i::n] for i in range(n)]
+
+
+def zip_plans(*plans):
+    """
+    Lazily pairs up the date_dicts of several plans window by window, stopping at the shortest. Yields tuples of 
+        date_dicts for a loop of your own, runners take the plans as a list of iterators to step them together instead
+    """
+    return zip(*plans)
+
+
+def chain_plans(*plans):
+    """
+    Lazily runs through the date_dicts of several plans one plan after the other. Runners take the result like a plan
+    """
+    return itertools.chain(*plans)
+
+
+def product_plans(*plans):
+    """
+    Lazily yields every combination of one date_dict from each plan, as tuples like zip_plans. WindowPlans are read by 
+        index, so only the date_dicts of the current combination are built. Other iterables are read into a list first
+    """
+    plans = [plan if isinstance(plan, WindowPlan) else list(plan) for plan in plans]
+    for indexes in itertools.product(*(range(len(plan)) for plan in plans)):
+        yield tuple(plan[i] for plan, i in zip(plans, indexes))
+
+
 class BackFillIterator(Iterator):
     """
     Abstract base class. A type of iterator for MVNO use which specifically uses a dictionary to format HQL queries with dates. 
     Allows user to iterate through a range of dates by specifying a start date and iterations along with a directional parameter 
         to control the direction of the iteration. 
 
+    Children only define _window(anchor), the window starting from an anchor date and the anchor of the window after it. 
+        All windows are computed once into a WindowTable and next()/peek() read from it. 
+
     Attributes
     ----------
     iter_int: int
@@ -25,7 +255,7 @@ class BackFillIterator(Iterator):
         number of iterations requested
 
     start_date: date
-        date object converted from user defined string of date. 
+        date object converted from user defined string of date. Set to the current window's start date while iterating
 
     end_date: date
         date object used to define the ending range for interval based queries (i.e. [start_date, end_date])
@@ -37,6 +267,12 @@ class BackFillIterator(Iterator):
     -------
     update_dict_dict(additional_params=dict):
         Takes additional params from a dictionary saves the class date variables into a dictionary
+
+    windows():
+        WindowTable holding every window of the iterator
+
+    plan():
+        Immutable WindowPlan of every window, whether or not next() already returned it
     
     """
     def __init__(self, start_date = TODAY, iterations = 0, backwards=True, logging=True, is_complete=False, iterator_abbrev=None, expand_days=[1,1]):
@@ -48,11 +284,15 @@ class BackFillIterator(Iterator):
         self.start_date = start_date
         self.expand_days = expand_days
         self.iterator_abbrev = iterator_abbrev
+        self._table = None
 
         ##Convert Date Strings to datetime objects
         if type(start_date) == str:
             self.start_date = datetime.datetime.strptime(self.start_date, "%Y-%m-%d").date()
 
+        # Date the first window is computed from
+        self._anchor = self.start_date
+
         if is_complete & backwards:
             self.logging=False
             self._next_complete_month()
@@ -62,6 +302,53 @@ class BackFillIterator(Iterator):
         self.end_date = None
 
 
+    def __iter__(self):
+        return self
+
+
+    @abstractmethod
+    def _window(self, anchor):
+        """
+        Returns (start_date, end_date, label_date, next_anchor) of the window starting from anchor
+        """
+
+
+    def windows(self):
+        if self._table is None or self._table.anchor != self._anchor or len(self._table) != self.iterations:
+            self._table = WindowTable(self._window, self._anchor, self.iterations, self.expand_days, self.iterator_abbrev)
+
+        return self._table
+
+
+    def plan(self):
+        return WindowPlan(self.windows(), iterator_name=self.__class__.__name__)
+
+
+    def peek(self):
+        # End date of the window next() will return
+        table = self.windows()
+        if self.iter_count < len(table):
+            return datetime.date.fromordinal(table.end[self.iter_count])
+
+        return self._window(table.next_anchor)[1]
+
+
+    def __next__(self):
+        if self.iter_count < self.iterations:
+            table = self.windows()
+            self.start_date, self.end_date, _ = table.window(self.iter_count)
+
+            # Collects all important date parameters into a dictionary 
+            self.date_dict = table.date_dict(self.iter_count)
+            if self.logging == True:
+                logging.info(f"\nIterator {self.__class__.__name__} {self.date_dict['year_month']} \n\t| Iteration {self.date_dict['month_name']} \n\t| Range [{self.start_date}, {self.end_date}]")
+
+            # Increment for next iteration
+            self.iter_count += 1    
+
+            return self.date_dict
+
+
     def update_date_dict(self, additional_params = {}):
         """
         Allows us to add parameters that we wanted changed after every iteration. 
@@ -76,24 +363,7 @@ class BackFillIterator(Iterator):
             ex. {"BillCycleMonthString": "May"}
         """
         
-        date_dict = {}
-        #Format dates in ET
-        date_dict['start_date'] = self.start_date
-        date_dict['end_date']   = self.end_date
-
-        #Format dates extensions
-        date_dict['start_date_expanded'] = self.start_date - datetime.timedelta(days=self.expand_days[0])
-        date_dict['end_date_expanded']   = self.end_date + datetime.timedelta(days=self.expand_days[1])
-
-        #Values that help with
-        date_dict["month_name"] = self.start_date.strftime("%B")
-        date_dict["year_month"] = self.start_date.strftime("%Y-%m")
-
-        #bill cycle dates based on the start and end dates - must start the prior month (specific to mvno cube so far)
-        date_dict['bill_cycle_start_date'] = (self.start_date - relativedelta(months=1)).replace(day=1)
-        date_dict['bill_cycle_end_date']   = self.end_date.replace(day=1)
-
-        date_dict["iterator_type"] = self.iterator_abbrev
+        date_dict = make_date_dict(self.start_date, self.end_date, self.start_date, self.expand_days, self.iterator_abbrev)
 
         date_dict.update(additional_params)
         if self.logging == True:
@@ -103,10 +373,10 @@ class BackFillIterator(Iterator):
 
 
     def _next_complete_month(self):
+        # Step back until the window ends on or before the start date
         start_date = self.start_date
-        while start_date < self.peek():
-            self.__next__()
-            self.iter_count -= 1
+        while start_date < self._window(self._anchor)[1]:
+            self._anchor = self._window(self._anchor)[3]
 
 
 class CalendarMonthIterator(BackFillIterator):
@@ -114,37 +384,15 @@ class CalendarMonthIterator(BackFillIterator):
     def __init__(self, start_date = TODAY, iterations = 0, backwards=True, logging=True, is_complete=False, expand_days=[1,1]):
         super().__init__(start_date, iterations, backwards, logging, is_complete, iterator_abbrev="cal", expand_days=expand_days)
         ## Month Iterators have start date beginning at first of month
-        
-
-    def __iter__(self):
-        return self
 
 
-    def peek(self):
-        start_date = self.start_date.replace(day=1)
+    def _window(self, anchor):
+        start_date = anchor.replace(day=1)
 
         # Sets the end date to the last date of the start-date's month. 
         end_date     = start_date + relativedelta(months=1) - datetime.timedelta(days=1)
 
-        return end_date
-
-
-    def __next__(self):
-        self.start_date = self.start_date.replace(day=1)
-
-        if self.iter_count < self.iterations:
-
-            # Sets the end date to the last date of the start-date's month. 
-            self.end_date     = self.start_date + relativedelta(months=1) - datetime.timedelta(days=1)
-
-            # Collects all important date parameters into a dictionary 
-            self.update_date_dict()
-
-            # Increment for next iteration
-            self.iter_count += 1    
-            self.start_date += relativedelta(months=self.iter_int) #iter_int is either -1 or 1
-
-            return self.date_dict
+        return start_date, end_date, start_date, start_date + relativedelta(months=self.iter_int) #iter_int is either -1 or 1
 
 
 class BillCycleIterator(BackFillIterator):
@@ -152,34 +400,14 @@ class BillCycleIterator(BackFillIterator):
     def __init__(self, start_date = TODAY, iterations = 0, backwards = True, logging=True, is_complete=False, expand_days=[1,1]):
         super().__init__(start_date, iterations, backwards, logging, is_complete, iterator_abbrev="bill-cycle", expand_days=expand_days)
 
-    def __iter__(self):
-        return self
-
-    
-    def peek(self):
-        start_date = self.start_date.replace(day=1)    
-            # Sets the end date to the 28 of the next month from the start date
-        end_date     = (start_date + relativedelta(months=1)).replace(day=28)
-    
-        return end_date
 
+    def _window(self, anchor):
+        start_date = anchor.replace(day=1)
 
-    def __next__(self):
-        self.start_date = self.start_date.replace(day=1)
+        # Sets the end date to the 28 of the next month from the start date
+        end_date     = (start_date + relativedelta(months=1)).replace(day=28)
 
-        if self.iter_count < self.iterations:
-            
-            # Sets the end date to the 28 of the next month from the start date
-            self.end_date     = (self.start_date + relativedelta(months=1)).replace(day=28)
-
-            # Collects all important date parameters into a dictionary   
-            self.update_date_dict()
-
-            # Increment for next iteration
-            self.iter_count += 1    
-            self.start_date += relativedelta(months=self.iter_int) #iter_int is either -1 or 1
-            
-            return self.date_dict
+        return start_date, end_date, start_date, start_date + relativedelta(months=self.iter_int) #iter_int is either -1 or 1
 
 
 class FiscalMonthIterator(BackFillIterator):
@@ -188,41 +416,13 @@ class FiscalMonthIterator(BackFillIterator):
         super().__init__(start_date, iterations, backwards, logging, is_complete, iterator_abbrev="fis", expand_days=expand_days)
         ## Fiscal Month of year will be represented as a date but really we just use the "YY-MM" designation to 
         ##   offer input to the "find_fiscal"         
-    def __iter__(self):
-        return self
-
-
-    def peek(self):
-        if self.iter_count == 0:
-            fiscal_moy = self.start_date
-        else:
-            fiscal_moy = self.fiscal_moy
-
-        fiscal_start_end = find_fiscal(fiscal_moy.year, fiscal_moy.month)
-        end_date     = fiscal_start_end["fis_end"]
-    
-        return end_date
 
 
-    def __next__(self):
-        if self.iter_count == 0:
-            self.fiscal_moy = self.start_date
-        fiscal_start_end = find_fiscal(self.fiscal_moy.year, self.fiscal_moy.month)
-        
-        if self.iter_count < self.iterations:
-            self.end_date     = fiscal_start_end["fis_end"]
-            self.start_date   = fiscal_start_end["fis_start"]
-            
-            # Collects all important date parameters into a dictionary   
-            #   Set additional params according to the Fiscal Month and not the Start Date as is the default
-            self.update_date_dict(additional_params={"year_month": self.fiscal_moy.strftime("%Y-%m"), "month_name": self.fiscal_moy.strftime("%B")})
-
-            # Increment for next iteration
-            self.iter_count += 1    
-            
-            self.fiscal_moy += relativedelta(months=self.iter_int) #iter_int is either -1 or 1 depending on "backwards"/ direction
+    def _window(self, fiscal_moy):
+        fiscal_start_end = fiscal_month(fiscal_moy.year, fiscal_moy.month)
 
-            return self.date_dict
+        # Set month_name/year_month according to the Fiscal Month and not the Start Date as is the default
+        return fiscal_start_end["fis_start"], fiscal_start_end["fis_end"], fiscal_moy, fiscal_moy + relativedelta(months=self.iter_int)
 
 
 class DailyIterator(BackFillIterator):
@@ -230,26 +430,9 @@ class DailyIterator(BackFillIterator):
     def __init__(self, start_date = TODAY, iterations = 0, backwards = True, logging=True, expand_days=[1,1]):
         super().__init__(start_date, iterations, backwards, logging, iterator_abbrev="daily", expand_days=expand_days)
 
-    def __iter__(self):
-        return self
 
-    def peek(self):
-        return self.start_date
-
-
-    def __next__(self):
-        if self.iter_count < self.iterations:
-            
-            self.end_date     = self.start_date
-
-            # Collects all important date parameters into a dictionary   
-            self.update_date_dict()
-
-            # Increment for next iteration
-            self.iter_count += 1    
-            self.start_date += relativedelta(days=self.iter_int) #iter_int is either -1 or 1
-
-            return self.date_dict
+    def _window(self, anchor):
+        return anchor, anchor, anchor, anchor + datetime.timedelta(days=self.iter_int) #iter_int is either -1 or 1
 
 
 class MultiDayIterator(BackFillIterator):
@@ -269,30 +452,14 @@ class MultiDayIterator(BackFillIterator):
         self.days = days - 1
 
         if backwards:
-            self.start_date -= relativedelta(days=self.days)
-
-
-    def __iter__(self):
-        return self
-
-    
-    def peek(self):
-        return self.start_date + relativedelta(days=self.days)
-
+            self.start_date -= datetime.timedelta(days=self.days)
+        self._anchor = self.start_date
 
-    def __next__(self):
-        if self.iter_count < self.iterations:
-            
-            self.end_date    = self.start_date + relativedelta(days=self.days)
 
-            # Collects all important date parameters into a dictionary   
-            self.update_date_dict()
+    def _window(self, anchor):
+        end_date = anchor + datetime.timedelta(days=self.days)
 
-            # Increment for next iteration
-            self.iter_count += 1    
-            self.start_date += relativedelta(days=self.iter_int*(self.days+1))
-
-            return self.date_dict
+        return anchor, end_date, anchor, anchor + datetime.timedelta(days=self.iter_int*(self.days+1))
 
 
 class FiscalCalendarMonthIterator(BackFillIterator):
@@ -301,41 +468,43 @@ class FiscalCalendarMonthIterator(BackFillIterator):
         super().__init__(start_date, iterations, backwards, logging, iterator_abbrev="date-range", expand_days=expand_days)
 
 
-    def __iter__(self):
-        return self
- 
+    def _window(self, fiscal_moy):
+        fiscal_start_end = fiscal_month(fiscal_moy.year, fiscal_moy.month)
 
-    def peek(self):
-        if self.iter_count == 0:
-            fiscal_moy = self.start_date
-        else:
-            fiscal_moy = self.fiscal_moy
+        # Ends on the last day of the calendar month the fiscal month ends in
+        end_date     = (fiscal_start_end["fis_end"] + relativedelta(months=1)).replace(day=1) - datetime.timedelta(days=1)
 
-        fiscal_start_end = find_fiscal(fiscal_moy.year, fiscal_moy.month)
-        start_date     = fiscal_start_end["fis_start"]
-    
-        # Sets the end date to the last date of the start-date's month. 
-        end_date     = start_date + relativedelta(months=1) - datetime.timedelta(days=1)
+        return fiscal_start_end["fis_start"], end_date, fiscal_moy, fiscal_moy + relativedelta(months=self.iter_int)
 
-        return end_date
 
-    def __next__(self):
-        if self.iter_count == 0:
-            self.fiscal_moy = self.start_date
-        fiscal_start_end = find_fiscal(self.fiscal_moy.year, self.fiscal_moy.month)
-        
-        if self.iter_count < self.iterations:
-            end_date     = fiscal_start_end["fis_end"]
-            self.end_date = (end_date + relativedelta(months=1)).replace(day=1) - datetime.timedelta(days=1)
-            self.start_date   = fiscal_start_end["fis_start"]
-            
-            # Collects all important date parameters into a dictionary   
-            #   Set additional params according to the Fiscal Month and not the Start Date as is the default
-            self.update_date_dict(additional_params={"year_month": self.fiscal_moy.strftime("%Y-%m"), "month_name": self.fiscal_moy.strftime("%B")})
+def coalesce_date_dicts(date_dicts):
+    """
+    Merges the date_dicts of adjacent windows into one window spanning their union, so a single query can load them all. 
+        Month names and the like are taken from the earliest window. The per-window values are kept alongside:
 
-            # Increment for next iteration
-            self.iter_count += 1    
-            
-            self.fiscal_moy += relativedelta(months=self.iter_int) #iter_int is either -1 or 1 depending on "backwards"/ direction
+        windows:      list of the original date_dicts in date order
+        window_count: number of windows merged
+        start_dates:  quoted, comma separated start dates ex. "'2020-05-01', '2020-05-02'" for use in IN (...) filters
+        end_dates:    quoted, comma separated end dates
+        year_months:  quoted, comma separated year_month values
 
-            return self.date_dict
+    Parameters
+    ----------
+    date_dicts: list
+        date_dict of each window, as returned by the iterators' next()
+    """
+    windows = sorted(date_dicts, key=lambda date_dict: date_dict["start_date"])
+
+    date_dict = dict(windows[0])
+    for key in ["start_date", "start_date_expanded", "bill_cycle_start_date"]:
+        date_dict[key] = min(window[key] for window in windows)
+    for key in ["end_date", "end_date_expanded", "bill_cycle_end_date"]:
+        date_dict[key] = max(window[key] for window in windows)
+
+    date_dict["windows"] = windows
+    date_dict["window_count"] = len(windows)
+    date_dict["start_dates"] = ", ".join(f"'{window['start_date']}'" for window in windows)
+    date_dict["end_dates"] = ", ".join(f"'{window['end_date']}'" for window in windows)
+    date_dict["year_months"] = ", ".join(f"'{window['year_month']}'" for window in windows)
+
+    return date_dict
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+import threading
+
+
+def query_hash(formatted_qs):
+    return hashlib.sha256(formatted_qs.encode("utf-8")).hexdigest()
+
+
+class CheckpointLedger():
+    """
+    Durable record of the completed units of a backfill, kept as a JSONL file so a failed run can resume where it stopped.
+        A unit is one HQLQuery run for one date window: (table_name, iterator_abbrev, start_date, end_date). Each unit is
+        stored with the hash of its formatted query, so changing the HQL file invalidates the units it already completed.
+
+    Attributes
+    ----------
+    path: str
+        Location of the JSONL file. Created on the first completed unit
+
+    entries: dictionary
+        {unit: query hash} of every completed unit. Later lines of the file win over earlier ones
+
+    Methods
+    -------
+    unit(table_name, run_settings):
+        Builds the unit key of an HQLQuery run from the window's run_settings
+
+    is_done(unit, formatted_qs):
+        True if the unit completed with this exact query. A unit completed with a different query is invalidated
+
+    record(unit, formatted_qs):
+        Appends a completed unit to the ledger
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as ledger:
+                for line in ledger:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    unit = (entry["table_name"], entry["iterator_abbrev"], entry["start_date"], entry["end_date"])
+                    if entry.get("query_hash"):
+                        self.entries[unit] = entry["query_hash"]
+                    else:
+                        self.entries.pop(unit, None)
+
+    @staticmethod
+    def unit(table_name, run_settings):
+        run_settings = run_settings or {}
+        return (table_name, run_settings.get("iterator_type"),
+                str(run_settings.get("start_date")), str(run_settings.get("end_date")))
+
+    def is_done(self, unit, formatted_qs):
+        with self._lock:
+            recorded = self.entries.get(unit)
+            if recorded is None:
+                return False
+            if recorded == query_hash(formatted_qs):
+                return True
+
+            logging.info(f"CheckpointLedger: query text of {unit} changed since it completed, invalidating it")
+            del self.entries[unit]
+            self._append(unit, None)
+            return False
+
+    def record(self, unit, formatted_qs):
+        with self._lock:
+            self.entries[unit] = query_hash(formatted_qs)
+            self._append(unit, self.entries[unit])
+
+    def _append(self, unit, hashed_qs):
+        table_name, iterator_abbrev, start_date, end_date = unit
+        entry = {"table_name": table_name, "iterator_abbrev": iterator_abbrev, "start_date": start_date, "end_date": end_date,
+                 "query_hash": hashed_qs, "recorded_at": datetime.datetime.now().isoformat()}
+
+        with open(self.path, "a") as ledger:
+            ledger.write(json.dumps(entry) + "\n")
+            ledger.flush()
+            os.fsync(ledger.fileno())
@@ -0,0 +1,133 @@
+import json
+import logging
+import datetime
+import threading
+from abc import ABC, abstractmethod
+
+
+class MetricsSink(ABC):
+    """
+    Base class for the destinations of HQLQuery metrics records. A record is a plain dictionary, one per HQLQuery
+        execution, with the fields below. Spark fields are None when the status tracker or UI couldn't supply them.
+
+        table_name, is_temp, iterator_type, start_date, end_date: what ran and for which window
+        status: "succeeded" or "failed", error: repr of the exception when failed
+        started_at: ISO timestamp of the start of the execution
+        render_seconds: time spent formatting the query string
+        backend: name of the execution backend, "spark" or "local" (see backends)
+        execution_seconds: time spent executing on the backend
+        statistics_seconds: time spent computing the statistics of a temp table (see HQLQuery compute_statistics)
+        job_group, job_ids, stage_ids: Spark job group of the execution and the jobs/stages it ran
+        rows_written, bytes_written: output records/bytes of those stages (temp table and INSERT writes)
+        peak_shuffle_bytes: largest shuffle read + write of a single stage
+
+    Methods
+    -------
+    emit(record):
+        Stores or forwards one record
+    """
+    @abstractmethod
+    def emit(self, record):
+        pass
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """
+    Keeps every record in the records list, ex. for tests or for summarizing a run at the end of a job
+    """
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+class JSONLMetricsSink(MetricsSink):
+    """
+    Appends every record to a JSONL file, one line per execution, so runs can be aggregated afterwards
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, "a") as metrics:
+                metrics.write(line + "\n")
+
+
+def new_record(hql_query, run_settings):
+    run_settings = run_settings or {}
+    return {"table_name": hql_query.table_name, "is_temp": hql_query.is_temp, "iterator_type": run_settings.get("iterator_type"),
+            "start_date": run_settings.get("start_date"), "end_date": run_settings.get("end_date"), "status": None, "error": None,
+            "started_at": datetime.datetime.now().isoformat(), "backend": getattr(getattr(hql_query, "backend", None), "name", None), "render_seconds": None, "execution_seconds": None, "statistics_seconds": None,
+            "job_group": None, "job_ids": None, "stage_ids": None, "rows_written": None, "bytes_written": None, "peak_shuffle_bytes": None}
+
+
+def spark_job_metrics(spark_context, job_group):
+    """
+    Collects the jobs and stages a job group ran through the status tracker, and their output and shuffle sizes
+        from the Spark UI's REST API. Fields that can't be collected (ex. the UI is disabled) are left as None.
+    """
+    tracker = spark_context.statusTracker()
+    job_ids = sorted(tracker.getJobIdsForGroup(job_group))
+    stage_ids = []
+    for job_id in job_ids:
+        job_info = tracker.getJobInfo(job_id)
+        if job_info is not None:
+            stage_ids.extend(job_info.stageIds)
+
+    metrics = {"job_ids": job_ids, "stage_ids": sorted(stage_ids)}
+    if not spark_context.uiWebUrl or not stage_ids:
+        return metrics
+
+    import urllib.request
+    rows, bytes_written, peak_shuffle = 0, 0, 0
+    try:
+        for stage_id in stage_ids:
+            url = f"{spark_context.uiWebUrl}/api/v1/applications/{spark_context.applicationId}/stages/{stage_id}"
+            with urllib.request.urlopen(url, timeout=5) as response:
+                for attempt in json.loads(response.read()):
+                    rows += attempt.get("outputRecords", 0)
+                    bytes_written += attempt.get("outputBytes", 0)
+                    peak_shuffle = max(peak_shuffle, attempt.get("shuffleReadBytes", 0) + attempt.get("shuffleWriteBytes", 0))
+    except Exception as error:
+        logging.debug(f"Metrics: couldn't read stage metrics of {job_group}: {error!r}")
+        return metrics
+
+    metrics.update({"rows_written": rows, "bytes_written": bytes_written, "peak_shuffle_bytes": peak_shuffle})
+    return metrics
+
+
+def stage_stragglers(spark_context, stage_id, attempt_id, ratio):
+    """
+    Running tasks of a stage attempt that have run ratio times longer than the median run time of its finished tasks,
+        from the Spark UI's REST API. Each is a dictionary with task_id, host, seconds and median_seconds. Empty when the
+        UI is unavailable or no task of the stage has finished yet.
+    """
+    if not spark_context.uiWebUrl:
+        return []
+
+    import urllib.request
+    stage_url = f"{spark_context.uiWebUrl}/api/v1/applications/{spark_context.applicationId}/stages/{stage_id}/{attempt_id}"
+    try:
+        with urllib.request.urlopen(f"{stage_url}/taskSummary?quantiles=0.5", timeout=5) as response:
+            median_seconds = json.loads(response.read())["executorRunTime"][0] / 1000
+        with urllib.request.urlopen(f"{stage_url}/taskList?status=running&length=10000", timeout=5) as response:
+            tasks = json.loads(response.read())
+    except Exception as error:
+        logging.debug(f"Metrics: couldn't read the tasks of stage {stage_id}: {error!r}")
+        return []
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stragglers = []
+    for task in tasks:
+        launched = datetime.datetime.strptime(task["launchTime"].replace("GMT", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z")
+        seconds = (now - launched).total_seconds()
+        if median_seconds > 0 and seconds > ratio * median_seconds:
+            stragglers.append({"task_id": task["taskId"], "host": task.get("host"), "seconds": seconds, "median_seconds": median_seconds})
+
+    return stragglers
@@ -1,7 +1,20 @@
 from .iterators import *
 from .utils import *
 from .file_io import *
+from .dag import QueryGraph, normalize_table, extract_temp_views, extract_predicate_columns
+from .ledger import CheckpointLedger, query_hash
+from .explain import ExplainReport, explain_window
+from .incremental import FingerprintCache
+from .session import SessionProvider
+from .backends import SparkBackend
+from .history import RunHistory, predict_schedule
+from .watchdog import BudgetExceeded
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import re
 import logging
+import contextlib
+import threading
+import time
 
         
 class HQLRunner():
@@ -17,15 +30,104 @@ class HQLRunner():
     is_temp: boolean
         optional boolean parameter to force all HQLQueries to be saved as local temp tables. 
 
+    temp_storage: str
+        optional "orc" or "memory" to override how all the temp HQLQueries keep their tables (see HQLQuery). A "memory" 
+        temp view is released as soon as the last query of the window reading it finishes. Views nothing in the runner 
+        reads are kept until the query runs again.
+
+    write_options: dictionary
+        optional write options (format, compression, partition_by, ...) applied over the write_options of all the HQLQueries 
+        (see HQLQuery). Temp tables only, the INSERT statements of the other queries decide their own layout.
+
+    compute_statistics: boolean
+        optional flag overriding compute_statistics of all the HQLQueries (see HQLQuery). Temp tables get column statistics 
+        on the columns the later queries of the runner join or filter them on, and the log shows how those queries' join 
+        strategies changed.
+
+    time_budget: float
+        optional seconds overriding the time_budget of all the HQLQueries (see HQLQuery). A query running past its budget is 
+        cancelled and its window is given up on (its later queries don't run), but the rest of the run carries on. The 
+        windows given up on are listed in failed_windows, retryable ones can simply be run again (ex. with resume).
+
+    metrics_sinks: MetricsSink or list
+        optional sinks overriding the metrics_sinks of all the HQLQueries (see HQLQuery and metrics.MetricsSink).
+
+    session: str or SessionProvider
+        optional named session configuration (see session.register_session_config) all the HQLQueries run in. The 
+        session is only created when the first query actually runs.
+
+    backend: ExecutionBackend
+        optional backend all the HQLQueries execute on (see backends), ex. backends.LocalBackend(data_dir) to run the same 
+        templates in process with DuckDB over local Parquet files. incremental and coalesce_windows need Spark, and 
+        explain() always plans with Spark.
+
+    incremental: str or FingerprintCache
+        optional path of a fingerprint file for incremental re-runs. A query (temp queries aside) is skipped when its 
+        formatted query, the queries feeding it and the versions of its input tables for the window are all unchanged 
+        since its last successful write of that window. A window is skipped whole when all of its queries are. 
+        incremental.stats() has the hit and miss counts.
+
+    dedupe: boolean
+        share executions between the windows of a run (ex. a FiscalMonthIterator and a CalendarMonthIterator landing on 
+        the same month). An execution is skipped when its formatted query and those of the queries feeding it are 
+        identical to the execution that last wrote its output tables in the run, concurrent windows wait for an identical 
+        execution still running. Defaults to True. shared_executions 
+        lists (table_name, label, shared label) for every skipped execution of the last run.
+
+    history: str or RunHistory
+        optional path of a run time history file. Every HQLQuery execution is added to it, and concurrent runs 
+        (max_in_flight above 1, arun) submit the windows expected to take longest first, so heavy month end windows don't 
+        finish last. Windows without history are estimated from their length in days. After the run, schedule has the 
+        predicted and actual seconds and finish time of every window.
+
+    max_in_flight: int
+        optional number of date windows the runner may execute at once. Defaults to 1 (strictly sequential). 
+        Windows are submitted on a thread pool against the shared SparkSession, each in its own FAIR scheduler pool, 
+        so set "spark.scheduler.mode" to "FAIR" on the session to let them share the cluster.
+
+    max_concurrent_queries: int
+        optional number of HQLQueries of the same window the runner may execute at once. Defaults to 1 (list order). 
+        Above 1 the queries are scheduled from their dependency graph (see plan()), a query starting as soon as 
+        the queries writing its inputs have finished.
+
+    ledger: str or CheckpointLedger
+        optional path of a JSONL checkpoint ledger. Every completed (table_name, iterator_abbrev, start_date, end_date) unit 
+        is recorded with the hash of its formatted query.
+
+    resume: boolean
+        skip the units already completed in the ledger. A unit whose formatted query changed since it completed is run again.
+
+    coalesce_windows: int
+        optional number of adjacent windows of the same iterator to merge into one execution spanning their union 
+        (see coalesce_date_dicts for the extra run_settings a template can use). Overwrites switch to dynamic partition 
+        overwrite for the run, so only the partitions the merged query writes are replaced.
+
     Methods 
     -------
-    run(run_settings, *iterator=None):
+    run(run_settings, *iterator=None, max_in_flight=None):
         Formats HQL Files with run_settings parameters and can use an iterator(s) to loop through different dates 
         Iterators CAN specify different repetition amounts although its not recommended per business precedent, but its possible
             a certain backfill failed at a certain iteration step for a certain iterator
+
+    run_concurrent(run_settings, iterators, max_in_flight):
+        Runs every date window of the iterator(s) on a bounded thread pool. Each window still runs its HQLQueries in order.
+
+    arun(run_settings, iterators=None, max_concurrent=None, timeout=None, executor=None):
+        asyncio version of run(). Every HQLQuery execution is awaited on an executor, at most max_concurrent at a time
+
+    aiterate(run_settings, iterators=None, max_concurrent=None, timeout=None, executor=None):
+        Async generator running the windows like arun(), yielding (label, run time) as each window finishes
+
+    plan(weights=None):
+        Prints the dependency graph of the HQLQueries and its critical path
+
+    explain(run_settings, iterators=None, date_columns=None):
+        Dry run. EXPLAIN COST for every (window, HQLQuery) pair without executing anything, returned as an ExplainReport
     
     """
-    def __init__(self, hql_queries, is_temp=None):
+    def __init__(self, hql_queries, is_temp=None, max_in_flight=None, max_concurrent_queries=None, ledger=None, resume=False, coalesce_windows=None,
+                 temp_storage=None, metrics_sinks=None, incremental=None, session=None, write_options=None, 
+                 dedupe=True, history=None, compute_statistics=None, time_budget=None, backend=None):
 
         hql_queries = [hql_queries] if type(hql_queries) is not list else hql_queries 
         self.hql_queries = []
@@ -41,8 +143,61 @@ class HQLRunner():
                 # Use the is_temp flag if you want to override the "is_temp" field for all the HQLQueries. 
                 hql_query.is_temp = is_temp
 
+        if temp_storage is not None:
+            for hql_query in self.hql_queries:
+                hql_query.temp_storage = temp_storage
+
+        if time_budget is not None:
+            for hql_query in self.hql_queries:
+                hql_query.time_budget = time_budget
+
+        if compute_statistics is not None:
+            for hql_query in self.hql_queries:
+                hql_query.compute_statistics = compute_statistics
+
+        if write_options is not None:
+            for hql_query in self.hql_queries:
+                hql_query.write_options = {**hql_query.write_options, **write_options}
+
+        if session is not None:
+            provider = session if isinstance(session, SessionProvider) else SessionProvider(session)
+            for hql_query in self.hql_queries:
+                hql_query.session, hql_query.spark = provider, None
+
+        if backend is not None:
+            for hql_query in self.hql_queries:
+                hql_query.backend = backend
+
+        if any(not isinstance(hql_query.backend, SparkBackend) for hql_query in self.hql_queries):
+            assert incremental is None and not coalesce_windows, "ERROR: incremental and coalesce_windows need the Spark backend"
+
+        if metrics_sinks is not None:
+            for hql_query in self.hql_queries:
+                hql_query.metrics_sinks = metrics_sinks if type(metrics_sinks) is list else [metrics_sinks]
+
+        self.history = RunHistory(history) if type(history) is str else history
+        if self.history is not None:
+            for hql_query in self.hql_queries:
+                if self.history not in hql_query.metrics_sinks:
+                    hql_query.metrics_sinks = hql_query.metrics_sinks + [self.history]
+        self.schedule = {}
+
+        self.max_in_flight = max_in_flight
+        self.max_concurrent_queries = max_concurrent_queries
+        self.ledger = CheckpointLedger(ledger) if type(ledger) is str else ledger
+        self.resume = resume
+        assert self.ledger is not None or not resume, "ERROR: Supply a ledger to resume from"
+        self.coalesce_windows = coalesce_windows
+        self.incremental = FingerprintCache(incremental) if type(incremental) is str else incremental
+        self.dedupe = dedupe
+        self._lock = threading.Lock()
+        self._graph_key, self._query_graph = None, None
+        self._iterate_sources = {}
+        self._reset_shared()
+        self.failed_windows = []
+
 
-    def run(self, run_settings = None, iterators = None):
+    def run(self, run_settings = None, iterators = None, max_in_flight = None, resume = None, dry_run = False):
         
         """
         Main Runner method that passess a formatted HQL Query through a spark engine. 
@@ -54,39 +209,692 @@ class HQLRunner():
 
         iterator: MvnoIterator
             Takes a possible MvnoIterator(s) and uses its next() functionality to loop through dates returning a dictionary of formatted date variables
+            A WindowPlan (or list of them) works too, ex. iterator.plan()[16:] to pick a backfill up at its 17th window, 
+            as does any iterable of date_dicts, ex. chain_plans(plan_2020, plan_2021)
+
+        max_in_flight: int
+            Overrides the runner's max_in_flight for this run. Anything above 1 runs the date windows concurrently. 
+
+        resume: boolean
+            Overrides the runner's resume flag. True skips the units already completed in the runner's ledger. 
+
+        dry_run: boolean
+            Plan instead of run, see explain(). Returns the ExplainReport
 
         """
-        self.done_iterate = 0
-        if iterators:
-            while self.iterate(run_settings, iterators):
-                continue
+        if dry_run:
+            return self.explain(run_settings, iterators)
+
+        max_in_flight = max_in_flight or self.max_in_flight
+        self._reset_shared()
+        self.failed_windows, self.schedule = [], {}
+        if resume is not None:
+            assert self.ledger is not None or not resume, "ERROR: Supply a ledger to resume from"
+            self.resume = resume
+
+        if iterators and self.coalesce_windows and self.coalesce_windows > 1:
+            self.run_coalesced(run_settings, iterators, max_in_flight)
+
+        elif iterators and max_in_flight and max_in_flight > 1:
+            self.run_concurrent(run_settings, iterators, max_in_flight)
+
+        elif iterators:
+            for label, window_settings in self._windows(run_settings, iterators):
+                self._run_queries(window_settings, label)
 
         else:
-            for hqlQuery in self.hql_queries:
-                hqlQuery.run(run_settings)
+            self._run_queries(dict(run_settings or {}))
+
+        self._log_summary()
 
     def iterate(self, run_settings = None, iterators = None):
         assert iterators is not None, "ERROR: Supply an iterator (BillCycleIterator, CalendarMonthIterator, etc.) "
-        
-        if not hasattr(self, "done_iterate"):
-            self.done_iterate = 0
 
         iterators = [ iterators] if type(iterators) is not list else iterators 
-        if self.done_iterate < len(iterators):
-            for iterator in iterators: #First pick an iterator
-                iterator.logging = False
-                if next(iterator, None) == None: #Added complexity for the case that iterators have differing iterations (should be rare)
-                    self.done_iterate += 1 
-                    if self.done_iterate == len(iterators):
-                        del self.done_iterate
-                    return
-                
-                for hqlQuery in self.hql_queries: #Then use that iterator to go over every HQLQuery
-                    run_settings.update(iterator.date_dict)
-                    logging.info(f"HQL Runner {hqlQuery.table_name} \n\t Executing Date Range: {iterator.__class__.__name__} ({run_settings['start_date']}, {run_settings['end_date']})")
-                    logging.info(iterator.date_dict)
-                    hqlQuery.run(run_settings)
-            return True
+        self._reset_shared() # Every call is one round of the iterators, executions are shared within it
+        for iterator in iterators: #First pick an iterator
+            # Plans don't move on by themselves, every round picks up where the previous one left them
+            _, source = self._iterate_sources.setdefault(id(iterator), (iterator, self._date_dicts(iterator)))
+            date_dict = next(source, None)
+            if date_dict is None: #Stops at the first exhausted iterator in case iterators have differing iterations (should be rare)
+                # The loop is over, a new loop over the same plans starts them from their first window again
+                for iterator in iterators:
+                    self._iterate_sources.pop(id(iterator), None)
+                return
+            
+            # Each window gets its own copy of the settings so the caller's dictionary is never updated in place
+            window_settings = {**(run_settings or {}), **date_dict}
+            logging.info(date_dict)
+            #Then use that iterator to go over every HQLQuery
+            self._run_queries(window_settings, f"Executing Date Range: {self._iterator_name(iterator)} ({window_settings['start_date']}, {window_settings['end_date']})")
+        return True
+
+    def run_concurrent(self, run_settings = None, iterators = None, max_in_flight = 2):
+        """
+        Runs the date windows of the iterator(s) concurrently. Windows are independent of each other, the HQLQueries 
+            inside a window still run in order. Runners with temp HQLQueries or scripts creating temp views log a warning 
+            and run the windows one at a time, like arun(). 
+
+        Parameters
+        ----------
+        run_settings: dictionary
+            Dictionary used to format variables in a query string. Copied for every window, never updated in place. 
+
+        iterators: MvnoIterator
+            Iterator(s) supplying the date windows. Windows are produced in the same order as the sequential run. 
+
+        max_in_flight: int
+            Maximum number of windows executing at the same time. 
+        """
+        assert iterators is not None, "ERROR: Supply an iterator (BillCycleIterator, CalendarMonthIterator, etc.) "
+        if self._shares_window_state():
+            self._warn_sequential()
+            for label, window_settings in self._windows(run_settings, iterators):
+                self._run_queries(window_settings, label)
+            return
+
+        windows = self._order_windows(list(self._windows(run_settings, iterators)), max_in_flight)
+        logging.info(f"HQL Runner: Submitting {len(windows)} windows, {max_in_flight} at a time")
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="HQLRunner") as executor:
+            futures = [executor.submit(self._run_window, window_settings, label) for label, window_settings in windows]
+            for (label, _), future in zip(windows, futures):
+                future.add_done_callback(lambda future, label=label: self._window_finished(label, future, time.time() - start))
+
+            # Collect in submission order so the summary logs are the same from run to run
+            for (label, _), future in zip(windows, futures):
+                try:
+                    run_time = future.result()
+                except Exception:
+                    logging.error(f"HQL Runner: {label} FAILED, cancelling windows that have not started")
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                logging.info(f"HQL Runner: {label} finished in {round(run_time / 60, 3)} minutes")
+
+    async def arun(self, run_settings = None, iterators = None, max_concurrent = None, timeout = None, executor = None):
+        """
+        asyncio version of run() for services orchestrating several runners from one event loop. Each HQLQuery execution 
+            is dispatched to an executor and awaited, so the loop never blocks on Spark. 
+
+        Parameters
+        ----------
+        run_settings: dictionary
+            Dictionary used to format variables in a query string
+
+        iterators: MvnoIterator or WindowPlan
+            Optional iterator(s) supplying the date windows. Windows run concurrently unless the runner has temp 
+            HQLQueries (their tables are shared between windows), the HQLQueries of a window always run in order.
+
+        max_concurrent: int or asyncio.Semaphore
+            Cap on the HQLQuery executions in flight. Pass the same asyncio.Semaphore to several runners to share one cap 
+            between them. Defaults to the runner's max_in_flight, else 1.
+
+        timeout: float
+            Optional seconds an HQLQuery execution may take. A timed out execution raises asyncio.TimeoutError.
+
+        executor: concurrent.futures.Executor
+            Optional executor the executions run on. Defaults to the event loop's default executor.
+
+        Cancelling the awaiting task (or a timeout) cancels the Spark job group of every execution in flight, so the 
+            cluster is freed rather than left finishing work nobody waits for.
+        """
+        start = time.time()
+        async for label, run_time in self.aiterate(run_settings, iterators, max_concurrent, timeout, executor):
+            self._window_finished(label, run_time, time.time() - start)
+            if label:
+                logging.info(f"HQL Runner: {label} finished in {round(run_time / 60, 3)} minutes")
 
+        self._log_summary()
+
+    async def aiterate(self, run_settings = None, iterators = None, max_concurrent = None, timeout = None, executor = None):
+        """
+        Async generator running the runner's windows like arun(), yielding (label, run time in seconds) as each window 
+            finishes. Closing the generator early cancels the windows still running. 
+        """
+        import asyncio # Imported here, asyncio alone costs more startup than the rest of the package
+        if isinstance(max_concurrent, asyncio.Semaphore):
+            semaphore = max_concurrent
         else:
+            semaphore = asyncio.Semaphore(max_concurrent or self.max_in_flight or 1)
+
+        windows = self._windows(run_settings, iterators) if iterators else [(None, dict(run_settings or {}))]
+        self._reset_shared()
+        self.failed_windows, self.schedule = [], {}
+
+        # Merged windows overwrite only their own partitions, like run_coalesced()
+        coalesced = bool(iterators and self.coalesce_windows and self.coalesce_windows > 1)
+        with self._dynamic_overwrite() if coalesced else contextlib.nullcontext():
+            workers = max_concurrent if type(max_concurrent) is int else self.max_in_flight
+            if self._shares_window_state():
+                if iterators and (isinstance(max_concurrent, asyncio.Semaphore) or (workers or 1) > 1):
+                    self._warn_sequential()
+                for label, window_settings in windows:
+                    yield await self._arun_window(window_settings, label, None, semaphore, timeout, executor)
+                return
+
+            windows = self._order_windows(list(windows), workers)
+            tasks = [asyncio.ensure_future(self._arun_window(window_settings, label, self._pool(window_settings) if iterators else None,
+                                                              semaphore, timeout, executor))
+                     for label, window_settings in windows]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _arun_window(self, window_settings, label, pool, semaphore, timeout, executor):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        async with semaphore:
+            window = await loop.run_in_executor(executor, self._prepare_window, window_settings, label)
+
+        try:
+            for hqlQuery in self.hql_queries if window is not None else []:
+                await self._arun_query(hqlQuery, window_settings, label, pool, window, semaphore, timeout, executor)
+        except BudgetExceeded as error:
+            self._window_failed(label, error)
+
+        return label, time.time() - start
+
+    async def _arun_query(self, hqlQuery, window_settings, label, pool, window, semaphore, timeout, executor):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        job_group = hqlQuery.new_job_group()
+        async with semaphore:
+            future = loop.run_in_executor(executor, self._run_query, hqlQuery, window_settings, label, pool, window, job_group)
+            try:
+                # shield keeps the executor future alive, the thread can only be stopped through Spark
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+                reason = "timed out" if isinstance(error, asyncio.TimeoutError) else "cancelled"
+                logging.error(f"HQL Runner: {hqlQuery.table_name} {reason}" + (f" for {label}" if label else ""))
+                # The execution's own error (Spark's cancellation) is superseded by the timeout/cancel raised here
+                future.add_done_callback(lambda future: future.cancelled() or future.exception())
+                # Hold the slot until the thread is free. Jobs the execution starts after the first cancel are cancelled too
+                while not future.done():
+                    hqlQuery.cancel(job_group)
+                    await asyncio.wait([future], timeout=1)
+                raise
+
+    def run_coalesced(self, run_settings = None, iterators = None, max_in_flight = None):
+        """
+        Runs the iterator(s) with every coalesce_windows adjacent windows of an iterator merged into one execution. 
+            Dynamic partition overwrite is switched on for the run so the merged writes only replace the partitions they touch. 
+        """
+        with self._dynamic_overwrite():
+            if max_in_flight and max_in_flight > 1:
+                self.run_concurrent(run_settings, iterators, max_in_flight)
+            else:
+                for label, window_settings in self._windows(run_settings, iterators):
+                    self._run_queries(window_settings, label)
+
+    @contextlib.contextmanager
+    def _dynamic_overwrite(self):
+        """
+        Switches the session to dynamic partition overwrite, restoring its previous settings on exit
+        """
+        spark = self.hql_queries[0].spark
+        overwrite_conf = {"spark.sql.sources.partitionOverwriteMode": "dynamic", "hive.exec.dynamic.partition.mode": "nonstrict"}
+        previous_conf = {key: spark.conf.get(key, None) for key in overwrite_conf}
+        for key, value in overwrite_conf.items():
+            spark.conf.set(key, value)
+
+        try:
+            yield
+        finally:
+            for key, value in previous_conf.items():
+                if value is None:
+                    spark.conf.unset(key)
+                else:
+                    spark.conf.set(key, value)
+
+    def _windows(self, run_settings, iterators):
+        """
+        Yields (label, settings) for every date window, stepping through the iterators the same way iterate() does 
+            and stopping as soon as one of them is exhausted. With coalesce_windows set, every coalesce_windows 
+            windows of an iterator are merged into one. 
+        """
+        iterators = [ iterators] if type(iterators) is not list else iterators 
+        batch_size = self.coalesce_windows or 1
+        batches = {id(iterator): [] for iterator in iterators}
+        sources = {id(iterator): self._date_dicts(iterator) for iterator in iterators}
+        window_num = 0
+
+        def window(iterator, date_dicts):
+            date_dict = coalesce_date_dicts(date_dicts) if batch_size > 1 else date_dicts[0]
+            merged = f" x{len(date_dicts)}" if batch_size > 1 else ""
+            label = f"Window {window_num} {self._iterator_name(iterator)}{merged} ({date_dict['start_date']}, {date_dict['end_date']})"
+            return label, {**(run_settings or {}), **date_dict}
+
+        while True:
+            for iterator in iterators:
+                date_dict = next(sources[id(iterator)], None)
+                if date_dict is None:
+                    # Flush the partial batches of every iterator
+                    for iterator in iterators:
+                        if batches[id(iterator)]:
+                            window_num += 1
+                            yield window(iterator, batches[id(iterator)])
+                    return
+
+                batches[id(iterator)].append(date_dict)
+                if len(batches[id(iterator)]) == batch_size:
+                    window_num += 1
+                    yield window(iterator, batches.pop(id(iterator)))
+                    batches[id(iterator)] = []
+
+    @staticmethod
+    def _iterator_name(iterator):
+        return getattr(iterator, "iterator_name", None) or iterator.__class__.__name__
+
+    @staticmethod
+    def _date_dicts(iterator):
+        """
+        date_dicts of a WindowPlan or any iterable of date_dicts, or of an iterator consumed through next() so it ends up 
+            where iterate() would leave it
+        """
+        if not isinstance(iterator, BackFillIterator):
+            for date_dict in iterator:
+                if not isinstance(date_dict, dict):
+                    raise TypeError(f"HQL Runner: windows have to be date_dicts, got a {type(date_dict).__name__}. zip_plans and product_plans "
+                                    "yield tuples of date_dicts, pass the plans as a list to step them together")
+                yield date_dict
+            return
+
+        iterator.logging = False
+        date_dict = next(iterator, None)
+        while date_dict is not None:
+            yield date_dict
+            date_dict = next(iterator, None)
+
+    def explain(self, run_settings = None, iterators = None, date_columns = None):
+        """
+        Dry run of a backfill. Renders every (window, HQLQuery) pair the same way run() would and has Spark analyze it 
+            with EXPLAIN COST, nothing is executed. Plans are cached by formatted query hash, so planning again is cheap. 
+            Queries reading temp tables that don't exist yet can't be analyzed and are reported with their error. 
+
+        Parameters
+        ----------
+        run_settings: dictionary
+            Dictionary used to format variables in a query string
+
+        iterators: MvnoIterator or WindowPlan
+            Windows to plan. Iterators are consumed like in run(), pass iterator.plan() to keep them untouched
+
+        date_columns: list
+            Partition columns holding the dates (ex. ["usage_date"]). Partition pruning is only checked on scans reading them
+
+        Returns
+        -------
+        ExplainReport
+        """
+        report = ExplainReport()
+        windows = self._windows(run_settings, iterators) if iterators else [(None, dict(run_settings or {}))]
+        for label, window_settings in windows:
+            explain_window(report, self.hql_queries, window_settings, label, date_columns)
+
+        logging.info(report.summary())
+        return report
+
+    def plan(self, weights=None):
+        """
+        Prints the dependency graph the runner schedules its HQLQueries with. Table names are matched on the unformatted 
+            query strings, so "{tmp_env}.voice_temp" written by a temp query links up with the queries reading it. 
+
+        Parameters
+        ----------
+        weights: dictionary
+            Optional {table_name: expected seconds} used to find the critical path. Every query counts as 1 otherwise.
+
+        Returns
+        -------
+        QueryGraph
+        """
+        graph = QueryGraph(self.hql_queries)
+        print(graph.describe(weights))
+
+        return graph
+
+    def _run_window(self, window_settings, label):
+        start = time.time()
+        self._run_queries(window_settings, label, self._pool(window_settings))
+
+        return time.time() - start
+
+    def _graph(self):
+        # Built once per set of queries rather than for every window. The key changes when a query's text or is_temp is changed
+        key = tuple((id(hql_query), hql_query.query_string, hql_query.is_temp, hql_query.table_name) for hql_query in self.hql_queries)
+        with self._lock:
+            if self._graph_key != key:
+                self._graph_key, self._query_graph = key, QueryGraph(self.hql_queries)
+            return self._query_graph
+
+    def _reset_shared(self):
+        # {rendered table name: (execution key, label)} of the last write of every table in the run
+        self._last_writes = {}
+        # {execution key: threading.Event} of the executions running, set once they finish
+        self._in_flight = {}
+        self.shared_executions = []
+
+    def _order_windows(self, windows, workers):
+        """
+        Longest expected window first when the runner has a history, with the predicted run time and finish of every 
+            window kept in schedule
+        """
+        self.schedule = {}
+        if self.history is None:
+            return windows
+
+        predicted = {label: self.history.predict_window(self.hql_queries, window_settings) for label, window_settings in windows}
+        windows = sorted(windows, key=lambda window: predicted[window[0]], reverse=True)
+        finishes = predict_schedule([predicted[label] for label, _ in windows], workers)
+        for (label, _), finish in zip(windows, finishes):
+            self.schedule[label] = {"predicted_seconds": predicted[label], "predicted_finish": finish, "actual_seconds": None, "actual_finish": None}
+
+        return windows
+
+    def _window_finished(self, label, run_time, finished_at):
+        if isinstance(run_time, Future):
+            if run_time.cancelled() or run_time.exception() is not None:
+                return
+            run_time = run_time.result()
+
+        if label in self.schedule:
+            with self._lock:
+                self.schedule[label].update({"actual_seconds": run_time, "actual_finish": finished_at})
+
+    def _log_summary(self):
+        if self.failed_windows:
+            logging.error(f"HQL Runner: {len(self.failed_windows)} windows ran past a time budget: " + ", ".join(str(failed["label"]) for failed in self.failed_windows))
+        if self.schedule:
+            predicted = max(window["predicted_finish"] for window in self.schedule.values())
+            actual = max((window["actual_finish"] or 0 for window in self.schedule.values()), default=0)
+            logging.info(f"HQL Runner: predicted to finish in {round(predicted / 60, 3)} minutes, finished in {round(actual / 60, 3)} minutes")
+            for label, window in self.schedule.items():
+                actual_seconds = round(window["actual_seconds"], 1) if window["actual_seconds"] is not None else None
+                logging.info(f"\t{label} | predicted {round(window['predicted_seconds'], 1)} s | actual {actual_seconds} s")
+        if self.shared_executions:
+            logging.info(f"HQL Runner: {len(self.shared_executions)} executions shared with identical ones of other windows")
+        if self.incremental is not None:
+            logging.info(f"HQL Runner: incremental skip cache {self.incremental.stats()}")
+
+    def _shares_window_state(self):
+        # Temp tables and the temp views of scripts have fixed names, so concurrent windows would overwrite each other's intermediates
+        return any(hql_query.is_temp or extract_temp_views(hql_query.query_string) for hql_query in self.hql_queries)
+
+    @staticmethod
+    def _warn_sequential():
+        logging.warning("HQL Runner: concurrent windows would share temp tables or temp views, running the windows one at a time")
+
+    @staticmethod
+    def _pool(window_settings):
+        # Every window lands in its own FAIR pool
+        return f"{window_settings['iterator_type']}_{window_settings['start_date']}"
+
+    def _run_queries(self, window_settings, label=None, pool=None):
+        window = self._prepare_window(window_settings, label)
+        if window is None:
+            return
+
+        try:
+            if self.max_concurrent_queries and self.max_concurrent_queries > 1:
+                self._run_graph(window_settings, label, pool, window)
+
+            else:
+                for hqlQuery in self.hql_queries:
+                    self._run_query(hqlQuery, window_settings, label, pool, window)
+        except BudgetExceeded as error:
+            self._window_failed(label, error)
+
+    def _window_failed(self, label, error):
+        # The window's later queries would read incomplete tables, the window is given up on but the run goes on
+        logging.error(f"HQL Runner: {error}, giving up on" + (f" {label}" if label else " the run") + " and carrying on")
+        with self._lock:
+            self.failed_windows.append({"label": label, "table_name": error.table_name, "error": str(error), "retryable": error.retryable})
+
+    def _prepare_window(self, window_settings, label=None):
+        """
+        Checks a window before its first query runs. Returns the window's fingerprints and execution keys (see 
+            _execution_keys), None when the window is skipped whole
+        """
+        # Catch missing run_settings for every query before the first one touches Spark
+        for hqlQuery in self.hql_queries:
+            missing = hqlQuery.template.missing(window_settings)
+            if missing:
+                raise KeyError(f"HQL Runner: {hqlQuery.table_name} needs run_settings {', '.join(sorted(missing))}")
+
+        # Temp tables only feed the window's other queries, so a resumed window whose outputs are all in the ledger is skipped whole
+        outputs = [hqlQuery for hqlQuery in self.hql_queries if not hqlQuery.is_temp]
+        if self.resume and outputs and all(self._completed(hqlQuery, window_settings) for hqlQuery in outputs):
+            logging.info("HQL Runner: every query already completed" + (f" for {label}" if label else "") + ", skipping")
+            return None
+
+        fingerprints = self._fingerprint_window(window_settings) if self.incremental is not None else {}
+        if fingerprints and all(unchanged for _, unchanged in fingerprints.values()):
+            logging.info("HQL Runner: inputs of every query unchanged" + (f" for {label}" if label else "") + ", skipping")
+            return None
+
+        self._count_view_readers()
+        self._plan_statistics(window_settings)
+        return {"fingerprints": fingerprints, "keys": self._execution_keys(window_settings) if self.dedupe else {}}
+
+    def _completed(self, hqlQuery, window_settings):
+        return self.ledger.is_done(CheckpointLedger.unit(hqlQuery.table_name, window_settings), hqlQuery.render(window_settings))
+
+    def _fingerprint_window(self, window_settings):
+        """
+        Fingerprints every non temp query of the window, returns {query index: (fingerprint, unchanged)}. Tables written by 
+            the queries feeding it aren't versioned, the formatted queries writing them are part of the fingerprint instead. 
+            Every other input is versioned, including tables the runner writes in queries that don't feed it (ex. last 
+            month's partition written by an earlier window). 
+            Queries fed by a query whose inputs can't all be extracted get no fingerprint, they always run.
+        """
+        graph = self._graph()
+        fingerprints = {}
+        for i, hqlQuery in enumerate(self.hql_queries):
+            if hqlQuery.is_temp:
+                continue
+
+            feeding, waiting = set(), [i]
+            while waiting:
+                j = waiting.pop()
+                if j not in feeding:
+                    feeding.add(j)
+                    waiting.extend(graph.dependencies[j])
+
+            # A barrier's inputs aren't all known (see dag.is_barrier), so a change to one of them couldn't be seen
+            if any(graph.barriers[j] for j in feeding):
+                fingerprint = None
+            else:
+                written = set().union(*(graph.writes[j] for j in feeding))
+                try:
+                    input_tables = {HQLTemplate(table).render(window_settings) for j in feeding for table in graph.reads[j] - written}
+                    formatted_queries = [self.hql_queries[j].render(window_settings) for j in sorted(feeding)]
+                    fingerprint = self.incremental.fingerprint(hqlQuery.spark, formatted_queries, input_tables, window_settings)
+                except KeyError:
+                    fingerprint = None
+            unit = CheckpointLedger.unit(hqlQuery.table_name, window_settings)
+            fingerprints[i] = (fingerprint, self.incremental.unchanged(unit, fingerprint))
+
+        return fingerprints
+
+    def _execution_keys(self, window_settings):
+        """
+        Identity of every query execution of the window, the hash of its formatted query and the keys of the queries it 
+            depends on. Two executions with the same key write the same data. Returns {query index: (key, written tables)}. 
+            "memory" temp queries are left out, their views are released after the window's last reader.
+        """
+        graph = self._graph()
+        hashes, keys = [], {}
+        for i, hqlQuery in enumerate(self.hql_queries):
+            hashes.append(query_hash(hqlQuery.render(window_settings) + "".join(hashes[j] for j in sorted(graph.dependencies[i]))))
+            if not (hqlQuery.is_temp and hqlQuery.temp_storage == "memory"):
+                keys[i] = (hashes[i], {normalize_table(HQLTemplate(table).render(window_settings)) for table in graph.writes[i]})
+
+        return keys
+
+    def _shared_execution(self, key, tables):
+        """
+        Label of the earlier execution of the run an execution can share, when the last write of every table it writes 
+            came from an identical execution. An identical execution still running is waited for first. None when it 
+            has to run, it's then in flight until _finish_execution and identical executions wait for it
+        """
+        if key is None or not tables:
+            return None
+
+        while True:
+            with self._lock:
+                last_writes = [self._last_writes.get(table) for table in tables]
+                if all(last_write is not None and last_write[0] == key for last_write in last_writes):
+                    return last_writes[0][1]
+
+                running = self._in_flight.get(key)
+                if running is None:
+                    self._in_flight[key] = threading.Event()
+                    return None
+
+            # When it fails its tables aren't recorded, and the next round runs the execution here instead
+            running.wait()
+
+    def _finish_execution(self, key):
+        with self._lock:
+            running = self._in_flight.pop(key, None)
+        if running is not None:
+            running.set()
+
+    def _plan_statistics(self, window_settings):
+        """
+        Points the temp queries computing statistics at the columns the window's later queries join or filter them on, 
+            and at those queries to compare their joins before and after
+        """
+        graph = self._graph()
+        for i, producer in enumerate(self.hql_queries):
+            if not (producer.is_temp and producer.compute_statistics):
+                continue
+
+            name = normalize_table(f"{{tmp_env}}.{producer.table_name}")
+            readers = [self.hql_queries[j] for j in range(i + 1, len(graph)) if name in graph.reads[j]]
+            producer.statistics_columns = set().union(*(extract_predicate_columns(reader.query_string, name) for reader in readers))
+            producer.statistics_probes = [(reader.table_name, reader.render(window_settings)) for reader in readers]
+
+    def _count_view_readers(self):
+        """
+        Counts the queries reading each "memory" temp table, so its view can be released after the last one finishes
+        """
+        graph = self._graph()
+        self._view_readers = [set() for _ in self.hql_queries]
+        self._view_counts = {}
+        for i, producer in enumerate(self.hql_queries):
+            if not (producer.is_temp and producer.temp_storage == "memory"):
+                continue
+
+            name = normalize_table(f"{{tmp_env}}.{producer.table_name}")
+            readers = [j for j in range(i + 1, len(graph)) if name in graph.reads[j]]
+            for j in readers:
+                self._view_readers[j].add(i)
+            self._view_counts[i] = len(readers)
+
+    def _use_views(self, formatted_qs, window_settings):
+        """
+        Points references to {tmp_env}.<table_name> at the temp view when the temp table is cached in memory
+        """
+        tmp_env = window_settings.get("tmp_env")
+        for hqlQuery in self.hql_queries:
+            if hqlQuery.view is None or tmp_env is None:
+                continue
+            reference = rf"(?<![\w.`])`?{re.escape(str(tmp_env))}`?\.`?{re.escape(hqlQuery.table_name)}`?(?![\w`])"
+            formatted_qs = re.sub(reference, hqlQuery.table_name, formatted_qs, flags=re.I)
+
+        return formatted_qs
+
+    def _release_views(self, hqlQuery):
+        with self._lock:
+            for i in self._view_readers[self.hql_queries.index(hqlQuery)]:
+                self._view_counts[i] -= 1
+                if self._view_counts[i] == 0:
+                    self.hql_queries[i].release_view()
+
+    def _run_graph(self, window_settings, label=None, pool=None, window=None):
+        """
+        Runs the window's HQLQueries concurrently, holding each one back until the queries it depends on have finished. 
+        """
+        graph = self._graph()
+        done, started, running = set(), set(), {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_queries, thread_name_prefix="HQLQuery") as executor:
+            while len(done) < len(graph):
+                for i in graph.ready(done, started):
+                    started.add(i)
+                    running[executor.submit(self._run_query, self.hql_queries[i], window_settings, label, pool, window)] = i
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    if future.exception() is not None:
+                        logging.error(f"HQL Runner: {self.hql_queries[i].table_name} FAILED, holding back the queries depending on it")
+                        for pending in running:
+                            pending.cancel()
+                        raise future.exception()
+                    done.add(i)
+
+    def _run_query(self, hqlQuery, window_settings, label=None, pool=None, window=None, job_group=None):
+        logging.info(f"HQL Runner {hqlQuery.table_name}" + (f" \n\t {label}" if label else "") + (f" [pool {pool}]" if pool else ""))
+        formatted_qs = hqlQuery.render(window_settings)
+
+        if self.ledger is not None:
+            unit = CheckpointLedger.unit(hqlQuery.table_name, window_settings)
+            if self.resume and not hqlQuery.is_temp and self.ledger.is_done(unit, formatted_qs):
+                logging.info(f"HQL Runner: {hqlQuery.table_name} already completed for {unit}, skipping")
+                self._release_views(hqlQuery)
+                return
+
+        window = window or {}
+        i = self.hql_queries.index(hqlQuery)
+        fingerprint, unchanged = window.get("fingerprints", {}).get(i, (None, False))
+        if unchanged:
+            logging.info(f"HQL Runner: {hqlQuery.table_name} inputs unchanged since its last write, skipping")
+            self._release_views(hqlQuery)
             return
+
+        key, tables = window.get("keys", {}).get(i, (None, set()))
+        shared = self._shared_execution(key, tables)
+        try:
+            try:
+                if shared is not None:
+                    logging.info(f"HQL Runner: {hqlQuery.table_name}" + (f" for {label}" if label else "") 
+                                 + f" is identical to the execution for {shared}, sharing it")
+                    with self._lock:
+                        self.shared_executions.append((hqlQuery.table_name, label, shared))
+
+                elif pool is None or not isinstance(hqlQuery.backend, SparkBackend):
+                    hqlQuery.run(window_settings, self._use_views(formatted_qs, window_settings), job_group)
+
+                else:
+                    # Local properties are per thread, so the pool is set in whichever thread runs the query
+                    spark_context = hqlQuery.spark.sparkContext
+                    spark_context.setLocalProperty("spark.scheduler.pool", pool)
+                    try:
+                        hqlQuery.run(window_settings, self._use_views(formatted_qs, window_settings), job_group)
+                    finally:
+                        spark_context.setLocalProperty("spark.scheduler.pool", None)
+            finally:
+                self._release_views(hqlQuery)
+
+            if key is not None:
+                with self._lock:
+                    for table in tables:
+                        self._last_writes[table] = (key, shared or label)
+        finally:
+            if shared is None and tables:
+                self._finish_execution(key)
+
+        if self.ledger is not None:
+            self.ledger.record(unit, formatted_qs)
+
+        if fingerprint is not None:
+            self.incremental.record(CheckpointLedger.unit(hqlQuery.table_name, window_settings), fingerprint)
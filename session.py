@@ -0,0 +1,64 @@
+import logging
+import threading
+
+
+# Named session configurations, {name: {spark conf key: value}}. See register_session_config
+SESSION_CONFIGS = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def register_session_config(name, config):
+    """
+    Registers a named set of Spark SQL configurations, ex. register_session_config("backfill", {"spark.sql.shuffle.partitions": "2000"}).
+        Runners and HQLQueries built with session="backfill" run in their own session with these configurations.
+    """
+    SESSION_CONFIGS[name] = dict(config)
+
+
+def get_session(name=None):
+    """
+    Shared SparkSession for a configuration name, created on the first call. pyspark is only imported here, so importing
+        the package or building HQLQueries never starts the JVM. The default session (name None) is the builder's
+        getOrCreate(). A named session is a newSession() of it: it shares the SparkContext, but has its own SQL
+        configurations, temp views and UDFs.
+    """
+    with _sessions_lock:
+        if name in _sessions:
+            return _sessions[name]
+
+        from pyspark.sql import SparkSession
+        spark = SparkSession.builder.getOrCreate()
+        if name is not None:
+            assert name in SESSION_CONFIGS, f"ERROR: No session configuration named {name}. Register it with register_session_config"
+            logging.info(f"SessionProvider: Creating session {name}")
+            spark = spark.newSession()
+            for key, value in SESSION_CONFIGS[name].items():
+                spark.conf.set(key, value)
+
+        _sessions[name] = spark
+        return spark
+
+
+class SessionProvider():
+    """
+    Hands out the SparkSession of a query lazily, on its first real execution rather than when the query is built.
+
+    Attributes
+    ----------
+    name: str
+        Name of a registered session configuration, None for the default session
+
+    Methods
+    -------
+    get():
+        The SparkSession, created on the first call
+    """
+    def __init__(self, name=None):
+        self.name = name
+
+    def get(self):
+        return get_session(self.name)
+
+    def __repr__(self):
+        return f"SessionProvider({self.name!r})"
@@ -0,0 +1,241 @@
+import os
+import re
+import time
+import fcntl
+import hashlib
+import logging
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .iterators import WindowPlan
+from .file_io import HQLTemplate
+from .backends import SparkBackend
+from .dag import COMMENTS, QueryGraph, normalize_table, extract_temp_views
+
+
+INSERT_PARTITION = re.compile(r"\bINSERT\s+(?:INTO|OVERWRITE)\s+(?:TABLE\s+)?([\w`.]+)\s*(?:PARTITION\s*\(([^)]*)\))?", re.I)
+
+
+class FileLocks():
+    """
+    Locks shared between processes, one lock file per key in directory. Locks are flock()s, so they are released by 
+        the OS when a process dies holding them.
+
+    Methods
+    -------
+    hold(keys, shared=()):
+        Context manager holding the exclusive locks of keys and the shared locks of shared
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        name = re.sub(r"[^\w.-]", "_", key)[:100]
+        return os.path.join(self.directory, f"{name}-{hashlib.sha1(key.encode()).hexdigest()[:8]}.lock")
+
+    @contextlib.contextmanager
+    def hold(self, keys, shared=()):
+        # Taken in sorted order, so two processes never hold one lock each while waiting on the other's
+        keys, lock_files = set(keys), []
+        try:
+            for key in sorted(keys | set(shared)):
+                lock_file = open(self.path(key), "a")
+                lock_files.append(lock_file)
+                fcntl.flock(lock_file, fcntl.LOCK_EX if key in keys else fcntl.LOCK_SH)
+            yield
+        finally:
+            for lock_file in reversed(lock_files):
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+
+def window_lock_keys(graph, window_settings):
+    """
+    Locks a window needs, from the rendered queries, as (exclusive, shared) sets of keys. A static partition an INSERT 
+        writes is locked exclusively as "<table>/<column>=<value>/...", with its table shared. Tables written whole are 
+        locked exclusively, so they wait for the writers of any of their partitions: INSERTs without a PARTITION spec or 
+        with dynamic partitions, temp tables (every window of a shard saves them under the same name, in the shard's own 
+        tmp_env, see shard_settings) and every other write. Temp views of scripts are local to each Spark application.
+    """
+    exclusive, shared = set(), set()
+    for hql_query, writes in zip(graph.hql_queries, graph.writes):
+        views = extract_temp_views(hql_query.query_string)
+        partitioned = set()
+        for table, spec in INSERT_PARTITION.findall(COMMENTS.sub(" ", hql_query.template.render(window_settings))):
+            table = normalize_table(table)
+            columns = [column.partition("=") for column in spec.split(",")] if spec.strip() else []
+            if columns and all(value.strip() for _, _, value in columns) and not hql_query.is_temp:
+                exclusive.add(table + "/" + "/".join(f"{name.strip().lower()}={value.strip().strip(chr(39) + chr(34))}" for name, _, value in columns))
+                shared.add(table)
+                partitioned.add(table)
+            else:
+                exclusive.add(table)
+
+        for table in writes - views:
+            table = normalize_table(HQLTemplate(table).render(window_settings))
+            if table not in partitioned:
+                exclusive.add(table)
+
+    return exclusive, shared - exclusive
+
+
+class ShardReport():
+    """
+    Status and timings of every window of a sharded backfill, merged from all the shards
+
+    Attributes
+    ----------
+    entries: list
+        One dictionary per window with shard, pid, window, start_date, end_date, status ("succeeded", "failed" or
+            "not run" after an earlier failure of its shard), error, retryable (ex. the window ran past its time budget), 
+            lock_wait_seconds and seconds
+
+    Methods
+    -------
+    failed():
+        Entries of the windows that failed or never ran
+
+    summary():
+        One line per shard, window counts and time spent running and waiting on locks
+    """
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        self.entries.append(entry)
+
+    def failed(self):
+        return [entry for entry in self.entries if entry["status"] != "succeeded"]
+
+    def summary(self):
+        lines = [f"Sharded backfill: {len(self)} windows, {len(self.failed())} failed or not run"]
+        for shard in sorted({entry["shard"] for entry in self.entries}):
+            entries = [entry for entry in self.entries if entry["shard"] == shard]
+            succeeded = sum(entry["status"] == "succeeded" for entry in entries)
+            seconds = sum(entry["seconds"] or 0 for entry in entries)
+            lock_wait = sum(entry["lock_wait_seconds"] or 0 for entry in entries)
+            lines.append(f"\tShard {shard} | {succeeded}/{len(entries)} windows succeeded | {round(seconds / 60, 3)} minutes"
+                         f" | {round(lock_wait / 60, 3)} minutes waiting on locks")
+            for entry in entries:
+                if entry["error"]:
+                    lines.append(f"\t\t{entry['window']} | ERROR {entry['error']}")
+
+        return "\n".join(lines)
+
+
+def shard_settings(run_settings, shard):
+    """
+    run_settings of a shard. tmp_env gets the shard's number as a suffix, so the temp tables of different shards never 
+        share a name and shards don't wait on each other's
+    """
+    run_settings = dict(run_settings or {})
+    if run_settings.get("tmp_env"):
+        run_settings["tmp_env"] = f"{run_settings['tmp_env']}_shard{shard}"
+
+    return run_settings
+
+
+def run_shard(shard, runner_factory, factory_args, run_settings, plan, lock_dir):
+    """
+    Worker of run_sharded. Builds the runner in this process, so its queries get this process's own Spark application,
+        and runs the shard's windows one by one while holding their locks. Stops at the first failed window.
+    """
+    runner = runner_factory(*factory_args)
+    graph = QueryGraph(runner.hql_queries)
+    locks = FileLocks(lock_dir)
+
+    run_settings = shard_settings(run_settings, shard)
+    spark_temp_queries = [hql_query for hql_query in runner.hql_queries if hql_query.is_temp and isinstance(hql_query.backend, SparkBackend)]
+    if spark_temp_queries and run_settings.get("tmp_env"):
+        spark_temp_queries[0].spark.sql(f"CREATE DATABASE IF NOT EXISTS {run_settings['tmp_env']}")
+
+    entries, failed = [], False
+    for i in range(len(plan)):
+        window_settings = {**(run_settings or {}), **plan[i]}
+        entry = {"shard": shard, "pid": os.getpid(), "window": f"{plan.iterator_name} ({window_settings['start_date']}, {window_settings['end_date']})",
+                 "start_date": window_settings["start_date"], "end_date": window_settings["end_date"], "status": "not run",
+                 "error": None, "retryable": False, "lock_wait_seconds": None, "seconds": None}
+        entries.append(entry)
+        if failed:
+            continue
+
+        start = time.time()
+        try:
+            # Renders the window's queries, a missing run_setting fails the window rather than the worker
+            lock_keys = window_lock_keys(graph, window_settings)
+            with locks.hold(*lock_keys):
+                entry["lock_wait_seconds"] = time.time() - start
+                start = time.time()
+                runner.run(run_settings, plan[i:i + 1])
+                entry["status"] = "succeeded"
+                # The runner gives up on a window past its time budget without raising
+                if runner.failed_windows:
+                    logging.error(f"Shard {shard}: {entry['window']} FAILED, skipping the rest of the shard")
+                    entry["status"], failed = "failed", True
+                    entry["error"] = "; ".join(failure["error"] for failure in runner.failed_windows)
+                    entry["retryable"] = all(failure["retryable"] for failure in runner.failed_windows)
+        except Exception as error:
+            logging.error(f"Shard {shard}: {entry['window']} FAILED, skipping the rest of the shard")
+            entry["status"], entry["error"], failed = "failed", repr(error), True
+        entry["seconds"] = time.time() - start
+
+    return entries
+
+
+def run_sharded(runner_factory, run_settings, iterator, shards, lock_dir, factory_args=()):
+    """
+    Runs a backfill split into shards, every shard in its own worker process with its own Spark application, so the
+        backfill isn't limited by one driver. The windows are dealt out round robin (see WindowPlan.shards). A window
+        holds file locks on the partitions and tables it writes while it runs (see window_lock_keys), so two shards never 
+        write the same ones at once. With local mode Spark in runner_factory every shard is a local application on one machine.
+
+    Parameters
+    ----------
+    runner_factory: callable
+        Module level function returning the HQLRunner, called in every worker with factory_args. Workers are spawned
+        processes, so the factory has to be importable and its arguments picklable
+
+    run_settings: dictionary
+        Dictionary used to format variables in a query string. Every shard gets its own tmp_env, suffixed with the 
+        shard's number (see shard_settings). Workers create it as a database when the runner has Spark temp queries
+
+    iterator: MvnoIterator or WindowPlan
+        Windows of the backfill
+
+    shards: int
+        Number of worker processes
+
+    lock_dir: str
+        Directory of the lock files. Every shard has to see the same directory
+
+    Returns
+    -------
+    ShardReport
+    """
+    plan = iterator if isinstance(iterator, WindowPlan) else iterator.plan()
+    report = ShardReport()
+    # Forking a driver with a running JVM isn't safe, every worker starts fresh
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=shards, mp_context=context) as executor:
+        futures = [(shard, sub_plan, executor.submit(run_shard, shard, runner_factory, factory_args, run_settings, sub_plan, lock_dir))
+                   for shard, sub_plan in enumerate(plan.shards(shards)) if len(sub_plan)]
+
+        for shard, sub_plan, future in futures:
+            try:
+                for entry in future.result():
+                    report.add(entry)
+            except Exception as error:
+                # The worker itself died, ex. its Spark application couldn't start
+                logging.error(f"Shard {shard}: worker FAILED {error!r}")
+                for date_dict in sub_plan:
+                    report.add({"shard": shard, "pid": None, "window": f"{sub_plan.iterator_name} ({date_dict['start_date']}, {date_dict['end_date']})",
+                                "start_date": date_dict["start_date"], "end_date": date_dict["end_date"], "status": "failed",
+                                "error": repr(error), "retryable": False, "lock_wait_seconds": None, "seconds": None})
+
+    logging.info(report.summary())
+    return report
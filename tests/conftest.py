@@ -0,0 +1,11 @@
+import os
+import sys
+import types
+
+
+# The checkout is the etl_pytools package (no __init__.py), registered under that name whatever the directory is called
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "etl_pytools" not in sys.modules:
+    package = types.ModuleType("etl_pytools")
+    package.__path__ = [ROOT]
+    sys.modules["etl_pytools"] = package
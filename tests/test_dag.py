@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+from etl_pytools.dag import (QueryGraph, extract_sources, extract_tables, extract_predicate_columns, is_barrier,
+                             split_statements, normalize_table)
+
+
+Query = namedtuple("Query", ["query_string", "is_temp", "table_name"])
+
+
+def test_comma_joins_read_every_table():
+    reads, writes = extract_tables("insert overwrite table {env}.b select * from {env}.dim x, {env}.a y where x.k = y.k")
+    assert reads == {"{env}.dim", "{env}.a"}
+    assert writes == {"{env}.b"}
+
+
+def test_comma_join_links_reader_to_writer():
+    graph = QueryGraph([Query("insert overwrite table {env}.a select 1", False, "a"),
+                        Query("insert overwrite table {env}.b select * from {env}.dim x, {env}.a y", False, "b")])
+    assert graph.dependencies == [set(), {0}]
+
+
+def test_from_inside_function_calls_is_not_a_table():
+    reads, _ = extract_tables("select extract(year from usage_date), trim(both ' ' from name), substring(s from 1 for 2) from {env}.usage u")
+    assert reads == {"{env}.usage"}
+
+
+def test_is_distinct_from_is_not_a_table():
+    assert extract_tables("select * from t where a is distinct from b")[0] == {"t"}
+
+
+def test_ctes_are_not_reads():
+    reads, _ = extract_tables("with recent as (select * from {env}.usage), totals as (select * from recent) "
+                              "select * from totals join {env}.accounts a on a.id = totals.id")
+    assert reads == {"{env}.usage", "{env}.accounts"}
+
+
+def test_subqueries_and_table_functions():
+    sources, complete = extract_sources("select * from (select * from a) q, b as bb left join c on c.x = bb.x, range(10) r")
+    assert complete
+    assert sorted(sources) == [("a", None), ("b", "bb"), ("c", None)]
+
+
+def test_tablesample_keeps_reading_the_from_list():
+    sources, complete = extract_sources("select * from t1 tablesample (10 percent) s, t2")
+    assert complete
+    assert sources == [("t1", "s"), ("t2", None)]
+
+
+def test_placeholders_keep_their_case():
+    assert extract_tables("insert overwrite table {ENV}.Out select * from {ENV}.Src")[0] == {"{ENV}.src"}
+    assert normalize_table("`{tmp_env}`.Voice_{X}") == "{tmp_env}.voice_{X}"
+
+
+def test_barriers():
+    assert is_barrier("truncate table {env}.a")
+    assert is_barrier("msck repair table {env}.a")
+    # A FROM clause that can't be parsed
+    assert is_barrier("select * from (a join b on a.x = b.x)")
+    assert not is_barrier("set spark.sql.shuffle.partitions=10; insert overwrite table b select * from a")
+
+
+def test_barrier_orders_every_query():
+    graph = QueryGraph([Query("insert overwrite table a select 1", False, "a"),
+                        Query("drop table if exists c", False, "c"),
+                        Query("insert overwrite table b select 1", False, "b")])
+    assert graph.barriers == [False, True, False]
+    # Queries after a barrier wait for it, and through it for everything before it
+    assert graph.dependencies == [set(), {0}, {1}]
+
+
+def test_semicolons_in_quotes_and_comments_dont_split():
+    script = ("-- load; the usage\n"
+              "create or replace temp view v as select ';' as sep, \"a;b\" as s, `c;d` from t; /* not; here */\n"
+              "insert overwrite table out select * from v;")
+    statements = split_statements(script)
+    assert len(statements) == 2
+    assert statements[0].endswith("`c;d` from t")
+    assert statements[1].endswith("insert overwrite table out select * from v")
+
+
+def test_statements_without_content_are_dropped():
+    assert split_statements("select 1; -- trailing comment\n;") == ["select 1"]
+
+
+def test_table_names_in_strings_and_comments_are_ignored():
+    reads, _ = extract_tables("select 'from fake' as s -- join other\nfrom real_table /* from hidden */")
+    assert reads == {"real_table"}
+
+
+def test_predicate_columns_skip_keywords():
+    query = "select * from {tmp_env}.voice v join b on v.id = b.id where v.d > 1 and x = 2 and y is not null and z between 1 and 3"
+    assert extract_predicate_columns(query, "{tmp_env}.voice") == {"id", "d", "x", "y", "z"}
+
+
+def test_predicate_columns_of_comma_joined_alias():
+    query = "select * from {env}.dim x, {tmp_env}.voice w where w.k = x.k"
+    assert extract_predicate_columns(query, "{tmp_env}.voice") == {"k"}
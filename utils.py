@@ -25,7 +25,9 @@ def timer_decorator(func):
         end_time = time.time()      # 2
         run_time, run_time_in_minutes = timer(start_time, end_time)
 
-        logging.info(f'  --- Finished {func.__name__!r} in {run_time} seconds. [{run_time_in_minutes} minutes]')
+        # The extra fields let a logging handler aggregate run times without parsing the message
+        logging.info(f'  --- Finished {func.__name__!r} in {run_time} seconds. [{run_time_in_minutes} minutes]',
+                     extra={"function": func.__name__, "run_time": run_time})
         return value
 
     return wrapper_timer 
@@ -0,0 +1,110 @@
+import time
+import logging
+import threading
+
+from .metrics import stage_stragglers
+
+
+# Seconds between two samples of a running HQLQuery's stages
+WATCHDOG_INTERVAL = 30
+# A running task is a straggler once it has run this many times the median run time of its stage's finished tasks
+STRAGGLER_RATIO = 5.0
+# Seconds between two cancellations of a job group past its budget, until its execution returns
+CANCEL_INTERVAL = 1
+
+
+class BudgetExceeded(RuntimeError):
+    """
+    An HQLQuery execution ran past its time budget and its Spark job group was cancelled. Retryable: the query itself
+        didn't fail, ex. a skewed window may fit its budget on a larger cluster or with more shuffle partitions.
+    """
+    retryable = True
+
+    def __init__(self, table_name, job_group, budget, elapsed):
+        super().__init__(f"{table_name} ran past its time budget of {budget} seconds ({round(elapsed, 1)} seconds, job group {job_group})")
+        self.table_name = table_name
+        self.job_group = job_group
+        self.budget = budget
+        self.elapsed = elapsed
+
+
+class Watchdog():
+    """
+    Watches the Spark jobs of one execution's job group from a background thread while the execution runs. Every
+        interval it logs the progress of the running stages and warns about straggler tasks (see STRAGGLER_RATIO).
+        Once the budget runs out it cancels the job group, and keeps cancelling it every CANCEL_INTERVAL until the 
+        execution returns, so jobs started afterwards (ex. by the next statement of a script) are stopped too. exceeded 
+        tells the execution why its jobs failed.
+
+    Attributes
+    ----------
+    exceeded: boolean
+        True once the watchdog cancelled the job group
+
+    elapsed: float
+        Seconds since the watchdog started
+    """
+    def __init__(self, spark_context, job_group, budget=None, name=None, interval=None, straggler_ratio=None):
+        self.spark_context = spark_context
+        self.job_group = job_group
+        self.budget = budget
+        self.name = name or job_group
+        self.interval = interval or WATCHDOG_INTERVAL
+        self.straggler_ratio = straggler_ratio or STRAGGLER_RATIO
+        self.exceeded = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name=f"Watchdog-{self.name}", daemon=True)
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start
+
+    def __enter__(self):
+        self._start = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _watch(self):
+        while True:
+            wait = self.interval if self.budget is None else max(0, min(self.interval, self.budget - self.elapsed))
+            if self._stop.wait(wait):
+                return
+
+            if self.budget is not None and self.elapsed >= self.budget:
+                logging.error(f"Watchdog: {self.name} ran past its budget of {self.budget} seconds, cancelling job group {self.job_group}")
+                self.exceeded = True
+                while True:
+                    self.spark_context.cancelJobGroup(self.job_group)
+                    if self._stop.wait(CANCEL_INTERVAL):
+                        return
+
+            try:
+                self.sample()
+            except Exception as error:
+                logging.debug(f"Watchdog: couldn't sample {self.name}: {error!r}")
+
+    def sample(self):
+        """
+        Logs the progress of every running stage of the job group and warns about its stragglers
+        """
+        tracker = self.spark_context.statusTracker()
+        for job_id in tracker.getJobIdsForGroup(self.job_group):
+            job_info = tracker.getJobInfo(job_id)
+            if job_info is None or job_info.status != "RUNNING":
+                continue
+
+            for stage_id in job_info.stageIds:
+                stage_info = tracker.getStageInfo(stage_id)
+                if stage_info is None or stage_info.numActiveTasks == 0:
+                    continue
+
+                logging.info(f"Watchdog: {self.name} {round(self.elapsed)} s | stage {stage_id}: {stage_info.numCompletedTasks}/{stage_info.numTasks} "
+                             f"tasks done, {stage_info.numActiveTasks} running, {stage_info.numFailedTasks} failed")
+                for task in stage_stragglers(self.spark_context, stage_id, stage_info.currentAttemptId, self.straggler_ratio):
+                    logging.warning(f"Watchdog: {self.name} straggler in stage {stage_id}: task {task['task_id']} on {task['host']} running "
+                                    f"{round(task['seconds'])} s, {round(task['seconds'] / task['median_seconds'], 1)}x the stage's median task")